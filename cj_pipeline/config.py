@@ -8,6 +8,7 @@ import sys
 BASE_DIR = Path(__file__).parents[1]
 LOGS_DIR = Path(BASE_DIR, "logs")
 LOGS_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR = Path(BASE_DIR, "data", "scratch", "cache")
 
 DEMOGRAPHICS = [
   "calc.race",
@@ -31,7 +32,10 @@ SMOOTHING = [
   'avg_pc',   # positive count
   'avg_pr',   # positive rate
   'avg_all',  # all values
+  'eb_pr',    # positive rate, pooled towards the POOLED_GROUPS trend
 ]
+# groups pooled over by the `eb_` (empirical Bayes) smoothers
+POOLED_GROUPS = ['offender_age', 'offender_sex']
 
 CRIMES = [
   'aggravated assault', 'property', 'robbery', 'sex offense', 'simple assault',
@@ -1,10 +1,36 @@
+import functools
 import pandas as pd
 from cj_pipeline.config import logger
+from cj_pipeline.utils import read_cached
 
 from pathlib import Path
 
 data_path = Path(__file__).parents[2] / 'data' / 'ncvs'
 
+# survey fields consumed by `preprocess`, all "(N) Label"-style
+LABEL_COLUMNS = [
+    'toc_code_new_ncvs',
+    'c_mult_off_race_black',
+    'c_mult_off_race_white',
+    'single_offender_race_end_2011_q4',
+    'multiple_offender_race_of_most_end_2011_q4',
+    'multiple_offender_race_of_most_start_2012_q1',
+    'c_single_offender_race_white_start_2012_q1',
+    'c_single_offender_race_black_or_african_american_start_2012_q1',
+    'single_offender_age',
+    'multiple_offenders_age_of_oldest',
+    'multiple_offenders_age_of_youngest',
+    'single_offender_sex',
+    'multiple_offenders_sex',
+    'multiple_offenders_mostly_male_or_female',
+    'reported_to_police',
+    'arrests_or_charges_made',
+]
+DTYPES = {
+    **{column: 'category' for column in LABEL_COLUMNS},
+    'ncvs_year': 'int16',
+}
+
 
 def rename(df: pd.DataFrame) -> pd.DataFrame:
     rename_dict = {
@@ -15,10 +41,22 @@ def rename(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def load() -> pd.DataFrame:
-    logger.info(f"Loading data from {data_path}")
-    df = pd.read_csv(data_path / 'ncvs.csv')
+def _read(path: Path) -> pd.DataFrame:
+    # `read_csv` decompresses the (single file) zip archive on the fly
+    return pd.read_csv(path, usecols=list(DTYPES), dtype=DTYPES)
+
+
+def load(use_cache: bool = True) -> pd.DataFrame:
+    path = data_path / 'ncvs.csv.zip'
+    if not path.is_file():  # already unzipped
+        path = data_path / 'ncvs.csv'
+    logger.info(f"Loading data from {path}")
+    read_fn = functools.partial(_read, path)
+    if use_cache:  # keyed by the source file and the columns read
+        df = read_cached(read_fn, path, key=tuple(DTYPES.items()))
+    else:
+        df = read_fn()
     logger.info(f"Loaded {len(df)} rows from {data_path}")
     logger.info(f"Renaming columns")
     df = rename(df)
-    return df
\ No newline at end of file
+    return df
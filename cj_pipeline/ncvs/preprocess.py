@@ -1,212 +1,155 @@
-import itertools
+import re
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
-from cj_pipeline.utils import smooth_arrest_rates
+from cj_pipeline.utils import expand_grid, map_distinct, smooth_arrest_rates_all
 from cj_pipeline.config import logger, SMOOTHING
 
 from typing import Dict
 
 
+# crime type ("(NN)" prefix of `toc_code_new_ncvs`) -> crime category
+CRIME_TYPES = {
+    1: "sex offense",          # (01) Completed rape
+    2: "sex offense",          # (02) Attempted rape
+    3: "sex offense",          # (03) Sex aslt w s aslt
+    4: "sex offense",          # (04) Sex aslt w m aslt
+    15: "sex offense",         # (15) Sex aslt wo inj
+    16: "sex offense",         # (16) Unw sex wo force
+    5: "robbery",              # (05) Rob w inj s aslt
+    6: "robbery",              # (06) Rob w inj m aslt
+    7: "robbery",              # (07) Rob wo injury
+    8: "robbery",              # (08) At rob inj s asl
+    9: "robbery",              # (09) At rob inj m asl
+    10: "robbery",             # (10) At rob w aslt
+    11: "aggravated assault",  # (11) Ag aslt w injury
+    12: "aggravated assault",  # (12) At ag aslt w wea
+    13: "aggravated assault",  # (13) Thr aslt w weap
+    14: "simple assault",      # (14) Simp aslt w inj
+    17: "simple assault",      # (17) Asl wo weap, wo inj
+    20: "simple assault",      # (20) Verbal thr aslt
+    21: "property",            # (21) Purse snatching
+    22: "property",            # (22) At purse snatch
+    23: "property",            # (23) Pocket picking
+    31: "property",            # (31) Burg, force ent
+    32: "property",            # (32) Burg, ent wo for
+    33: "property",            # (33) Att force entry
+    40: "property",            # (40) Motor veh theft
+    41: "property",            # (41) At mtr veh theft
+    54: "property",            # (54) Theft < $10
+    55: "property",            # (55) Theft $10-$49
+    56: "property",            # (56) Theft $50-$249
+    57: "property",            # (57) Theft $250+
+    58: "property",            # (58) Theft value NA
+    59: "property",            # (59) Attempted theft
+}
+
+
+def _label_code(label):
+    """Numeric "(NN)" prefix of a survey label, None if there is none."""
+    match = re.match(r"\((\d+)\)", label) if isinstance(label, str) else None
+    return int(match.group(1)) if match else None
+
+
 def _process_crime_type(df: pd.DataFrame) -> pd.DataFrame:
     def _crime_type(crime_type):
-        if crime_type in [
-            "(01) Completed rape",
-            "(02) Attempted rape",
-            "(03) Sex aslt w s aslt",
-            "(04) Sex aslt w m aslt",
-            "(15) Sex aslt wo inj",
-            "(16) Unw sex wo force"
-            ]:
-            return "sex offense"
-        elif crime_type in [
-            "(05) Rob w inj s aslt",
-            "(06) Rob w inj m aslt",
-            "(07) Rob wo injury",
-            "(08) At rob inj s asl",
-            "(09) At rob inj m asl",
-            "(10) At rob w aslt"
-            ]:
-            return "robbery"
-        elif crime_type in [
-            "(11) Ag aslt w injury",
-            "(12) At ag aslt w wea",
-            "(13) Thr aslt w weap"
-            ]:
-            return "aggravated assault"
-        elif crime_type in [
-            "(14) Simp aslt w inj",
-            "(17) Asl wo weap, wo inj",
-            "(20) Verbal thr aslt"
-            ]:
-            return "simple assault"
-        elif crime_type in [
-            "(21) Purse snatching",
-            "(22) At purse snatch",
-            "(23) Pocket picking",
-            "(40) Motor veh theft",
-            "(59) Attempted theft",
-            "(41) At mtr veh theft",
-            "(23) Pocket picking",
-            "(54) Theft < $10",
-            "(55) Theft $10-$49",
-            "(56) Theft $50-$249",
-            "(57) Theft $250+",
-            "(58) Theft value NA",
-            "(59) Attempted theft"
-            ]:
-            return "property"
-        elif crime_type in [
-            "(31) Burg, force ent",
-            "(32) Burg, ent wo for",
-            "(33) Att force entry"
-            ]:
-            return "property"
-        else:
-            return None
+        return CRIME_TYPES.get(_label_code(crime_type))
 
-    tqdm.pandas(desc='Processing Crime Type')
-    df['crime_recode'] = df['crime_type'].progress_apply(_crime_type)
+    # one lookup per distinct label, broadcast to the rows
+    df['crime_recode'] = map_distinct(df['crime_type'], _crime_type)
     df = df.dropna(subset=['crime_recode'], axis=0)
     return df
 
 
+def _select(choices, default=None):
+    """Value of the first `(condition, value)` pair that holds, per row."""
+    conditions, values = zip(*choices)
+    conditions = [c.to_numpy(dtype=bool) for c in conditions]
+    return np.select(conditions, values, default=default)
+
+
 def _process_offender_race(df: pd.DataFrame) -> pd.DataFrame:
-    def _offender_race(row):
-        if row["c_mult_off_race_black"] == "(1) Yes":
-            return "Black"
-        elif row["c_mult_off_race_white"] == "(1) Yes":
-            return "White"
-        elif row["single_offender_race_end_2011_q4"] == "(1) White":
-            return "White"
-        elif row["single_offender_race_end_2011_q4"] == "(2) Black":
-            return "Black"
-        elif row["multiple_offender_race_of_most_end_2011_q4"] == "(1) Mostly White":
-            return "White"
-        elif row["multiple_offender_race_of_most_end_2011_q4"] == "(2) Mostly Black":
-            return "Black"
-        elif row["multiple_offender_race_of_most_start_2012_q1"] == "(1) Mostly White":
-            return "White"
-        elif row["multiple_offender_race_of_most_start_2012_q1"] == "(2) Mostly Black":
-            return "Black"
-        elif row["c_single_offender_race_white_start_2012_q1"] == "(1) Yes":
-            return "White"
-        elif row["c_single_offender_race_black_or_african_american_start_2012_q1"] == "(1) Yes":
-            return "Black"
-        else:
-            return None
-    tqdm.pandas(desc='Processing Offender Race')
-    df["offender_race"] = df.progress_apply(_offender_race, axis=1)
+    single_2011 = df["single_offender_race_end_2011_q4"]
+    multiple_2011 = df["multiple_offender_race_of_most_end_2011_q4"]
+    multiple_2012 = df["multiple_offender_race_of_most_start_2012_q1"]
+    df["offender_race"] = _select([
+        (df["c_mult_off_race_black"] == "(1) Yes", "Black"),
+        (df["c_mult_off_race_white"] == "(1) Yes", "White"),
+        (single_2011 == "(1) White", "White"),
+        (single_2011 == "(2) Black", "Black"),
+        (multiple_2011 == "(1) Mostly White", "White"),
+        (multiple_2011 == "(2) Mostly Black", "Black"),
+        (multiple_2012 == "(1) Mostly White", "White"),
+        (multiple_2012 == "(2) Mostly Black", "Black"),
+        (df["c_single_offender_race_white_start_2012_q1"] == "(1) Yes", "White"),
+        (df["c_single_offender_race_black_or_african_american_start_2012_q1"]
+         == "(1) Yes", "Black"),
+    ])
     df = df.dropna(subset=['offender_race'], axis=0)
     return df
 
-# For adding Hispanic, add:
-#         if row["multiple_offenders_hispanic_non_hispanic_start_2012_q1"] == "(1) Mostly Hispanic or Latino":
-#             return "Hispanic"
-#        elif row["single_offender_hispanic_latino_start_2012_q1"] == "(1) Yes":
-#           return "Hispanic"
+# For adding Hispanic, add (before the other conditions):
+#         (df["multiple_offenders_hispanic_non_hispanic_start_2012_q1"]
+#          == "(1) Mostly Hispanic or Latino", "Hispanic"),
+#         (df["single_offender_hispanic_latino_start_2012_q1"] == "(1) Yes",
+#          "Hispanic"),
 
 
 def _process_offender_age(df: pd.DataFrame) -> pd.DataFrame:
-    def _offender_age(row):
-        low, mid, high = '< 18', '18-29', '> 29'
-        if row["single_offender_age"] == "(1) Under 12":
-            return low
-        elif row["single_offender_age"] == "(2) 12-14":
-            return low
-        elif row["single_offender_age"] == "(3) 15-17":
-            return low
-        elif row["single_offender_age"] == "(4) 18-20":
-            return mid
-        elif row["single_offender_age"] == "(5) 21-29":
-            return mid
-        elif row["single_offender_age"] == "(6) 30+":
-            return high
-        elif (
-            (row["multiple_offenders_age_of_oldest"] == row["multiple_offenders_age_of_youngest"])
-            and row["multiple_offenders_age_of_oldest"] == "(1) Under 12"
-        ):
-            return low
-        elif (
-            (row["multiple_offenders_age_of_oldest"] == row["multiple_offenders_age_of_youngest"])
-            and row["multiple_offenders_age_of_oldest"] == "(2) 12-14"
-        ):
-            return low
-        elif ((row["multiple_offenders_age_of_oldest"] == row["multiple_offenders_age_of_youngest"])
-              and row["multiple_offenders_age_of_oldest"] == "(3) 15-17"):
-            return low
-        elif (
-            (row["multiple_offenders_age_of_oldest"] == row["multiple_offenders_age_of_youngest"])
-            and row["multiple_offenders_age_of_oldest"] == "(4) 18-20"
-        ):
-            return mid
-        elif (
-            (row["multiple_offenders_age_of_oldest"] == row["multiple_offenders_age_of_youngest"])
-            and row["multiple_offenders_age_of_oldest"] == "(5) 21-29"
-        ):
-            return mid
-        elif (
-            (row["multiple_offenders_age_of_oldest"] == row["multiple_offenders_age_of_youngest"])
-            and row["multiple_offenders_age_of_oldest"] == "(6) 30+"
-        ):
-            return high
-        else:
-            return None
-    tqdm.pandas(desc='Processing Offender Age')
-    df["offender_age"] = df.progress_apply(_offender_age, axis=1)
+    low, mid, high = '< 18', '18-29', '> 29'
+    ages = [
+        ("(1) Under 12", low),
+        ("(2) 12-14", low),
+        ("(3) 15-17", low),
+        ("(4) 18-20", mid),
+        ("(5) 21-29", mid),
+        ("(6) 30+", high),
+    ]
+    single = df["single_offender_age"]
+    oldest = df["multiple_offenders_age_of_oldest"]
+    youngest = df["multiple_offenders_age_of_youngest"]
+    # multiple offenders only if the oldest and youngest are in the same bin
+    df["offender_age"] = _select(
+        [(single == label, age) for label, age in ages]
+        + [((oldest == label) & (youngest == label), age) for label, age in ages]
+    )
     df = df.dropna(subset=['offender_age'], axis=0)
     return df
 
 
 def _process_offender_sex(df: pd.DataFrame) -> pd.DataFrame:
-    def _offender_sex(row):
-        if row["single_offender_sex"] == "(1) Male":
-            return "Male"
-        elif row["single_offender_sex"] == "(2) Female":
-            return "Female"
-        elif row["multiple_offenders_sex"] == "(1) All male":
-            return "Male"
-        elif row["multiple_offenders_sex"] == "(2) All female":
-            return "Female"
-        elif row["multiple_offenders_mostly_male_or_female"] == "(1) Mostly male":
-            return "Male"
-        elif row["multiple_offenders_mostly_male_or_female"] == "(2) Mostly female":
-            return "Female"
-        else:
-            return None
-    tqdm.pandas(desc='Processing Offender Sex')
-    df["offender_sex"] = df.progress_apply(_offender_sex, axis=1)
+    single = df["single_offender_sex"]
+    multiple = df["multiple_offenders_sex"]
+    mostly = df["multiple_offenders_mostly_male_or_female"]
+    df["offender_sex"] = _select([
+        (single == "(1) Male", "Male"),
+        (single == "(2) Female", "Female"),
+        (multiple == "(1) All male", "Male"),
+        (multiple == "(2) All female", "Female"),
+        (mostly == "(1) Mostly male", "Male"),
+        (mostly == "(2) Mostly female", "Female"),
+    ])
     df = df.dropna(subset=['offender_sex'], axis=0)
     return df
 
 
 def _process_reported_to_police(df: pd.DataFrame) -> pd.DataFrame:
-    def _reported_to_police(reported_to_police):
-        if reported_to_police == "(1) Yes":
-            return 1
-        elif reported_to_police == "(2) No":
-            return 0
-        else:
-            return None
-    tqdm.pandas(desc='Processing Reported to the Police')
-    df["reported_to_police"] = df["reported_to_police"].progress_apply(_reported_to_police)
+    reported = df["reported_to_police"]
+    df["reported_to_police"] = _select([
+        (reported == "(1) Yes", 1.0),
+        (reported == "(2) No", 0.0),
+    ], default=np.nan)
     return df
 
 
 def _process_arrests_or_charges_made(df: pd.DataFrame) -> pd.DataFrame:
-    def _arrests_or_charges_made(row):
-        if row["arrests_or_charges_made"] == "(1) Yes":
-            return 1
-        elif row["arrests_or_charges_made"] == "(2) No":
-            return 0
-        elif row["arrests_or_charges_made"] == "(9) Out of universe":
-            return 0
-        elif row["reported_to_police"] == 0:
-            return 0
-        else:
-            return None
-    tqdm.pandas(desc='Processing arrests or charges made')
-    df["arrests_or_charges_made"] = df.progress_apply(_arrests_or_charges_made, axis=1)
+    arrests = df["arrests_or_charges_made"]
+    df["arrests_or_charges_made"] = _select([
+        (arrests == "(1) Yes", 1.0),
+        (arrests == "(2) No", 0.0),
+        (arrests == "(9) Out of universe", 0.0),
+        (df["reported_to_police"] == 0, 0.0),
+    ], default=np.nan)
     df = df[df["arrests_or_charges_made"].notnull()]
     return df
 
@@ -231,7 +174,9 @@ def preprocess(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
   return dfs
 
 
-def compute_arrest_rates(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+def compute_arrest_rates(
+    df: pd.DataFrame, n_boot: int = None) -> Dict[str, pd.DataFrame]:
+    """With `n_boot`, adds bootstrap bands `arrest_rate_smooth_lo`/`_hi`."""
     x_col, count_col = 'ncvs_year', 'count'
     arrest_col, smooth_col = 'arrest_rate', 'arrest_rate_smooth'
     groups = ['offender_race', 'offender_age', 'offender_sex', 'crime_recode', x_col]
@@ -248,24 +193,24 @@ def compute_arrest_rates(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
       inplace=True)
 
     # ensure we predict data for all years and groups
-    all_combinations = itertools.product(*[df[c].unique() for c in groups])
-    all_combinations = pd.DataFrame(all_combinations, columns=groups)
-    agg = pd.merge(all_combinations, agg, how='left', on=groups)
+    agg = expand_grid(agg, groups, levels=[df[c].unique() for c in groups])
 
-    # compute smoothed arrest rates
+    # compute smoothed arrest rates, all modes at once
     smoothed = {}
     x_test = agg[x_col].unique()[:, None]
-    for mode in SMOOTHING:
-      smoothed_arrests = smooth_arrest_rates(
-        df=agg,
-        groups=groups,
-        x_test=x_test,
-        x_col=x_col,
-        count_col=count_col,
-        arrest_col=arrest_col,
-        smooth_col=smooth_col,
-        mode=mode,
-      )
-      smoothed[mode] = pd.merge(agg, smoothed_arrests, how='left', on=groups)
+    smoothed_arrests = smooth_arrest_rates_all(
+      df=agg,
+      groups=groups,
+      x_test=x_test,
+      x_col=x_col,
+      count_col=count_col,
+      arrest_col=arrest_col,
+      smooth_col=smooth_col,
+      modes=SMOOTHING,
+      n_boot=n_boot,
+    )
+    for mode, smoothed_mode in smoothed_arrests.groupby('smoothing', sort=False):
+      smoothed_mode = smoothed_mode.drop(columns='smoothing')
+      smoothed[mode] = pd.merge(agg, smoothed_mode, how='left', on=groups)
 
     return smoothed
@@ -133,10 +133,9 @@ def _adjust_rates(df, rate_mult):
 
 @lru_cache
 def _get_neulaw(start_year: int) -> pd.DataFrame:
-  df = load_neulaw(base_path / 'neulaw')
+  df = load_neulaw(base_path / 'neulaw', start_year=start_year)
 
-  # subset year and handle special column values
-  df = df[df['calc.year'] >= start_year]
+  # handle special column values
   df = df[df['def.gender'].isin(('Female', 'Male'))]
   df = df[df['calc.race'].isin(('Black', 'White', 'Hispanic'))]
   df = df[df['def.race'].isin(('Black', 'White'))]
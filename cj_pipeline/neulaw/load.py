@@ -1,11 +1,34 @@
 import pandas as pd
 from pathlib import Path
 from cj_pipeline.config import logger
+from cj_pipeline.utils import concat_chunks
 
+# charge fields consumed by `preprocess` and `assignment_preprocessing`
+DATE_COLUMNS = ['case.date', 'off.date', 'disp.date', 'def.dob']
+DTYPES = {
+    'calc.disp': 'category',
+    'calc.broad': 'category',
+    'case.degree': 'category',
+    'off.code': 'float64',
+}
+COLUMNS = [
+    'def.uid',
+    'def.gender',
+    'def.race',
+    'calc.race',
+    'calc.year',
+    'calc.casenr',
+    'calc.detailed',
+    'disp.literal',
+    *DTYPES,
+    *DATE_COLUMNS,
+]
+_CHUNKSIZE = 200_000
 
-def load(base_path: Path):
+
+def load(base_path: Path, start_year: int = None, end_year: int = None):
     logger.info(f"Loading data from {base_path}")
-    hc = _load_hc(base_path)
+    hc = _load_hc(base_path, start_year=start_year, end_year=end_year)
     logger.info(f"Loaded {len(hc)} rows from {base_path}")
     logger.info(f"Merging offense categories")
     hc = merge_offense_categories(base_path, hc)
@@ -19,10 +42,43 @@ def merge_offense_categories(base_path: Path, df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def _load_hc(base_path: Path, sample_idxs: list[int] | None = None) -> pd.DataFrame:
+def _read(path: Path, **kwargs):
+    return pd.read_csv(
+        path, usecols=COLUMNS, dtype=DTYPES, parse_dates=DATE_COLUMNS, **kwargs)
+
+
+def _filter_years(
+        df: pd.DataFrame, start_year: int = None, end_year: int = None
+) -> pd.DataFrame:
+    if start_year is not None:
+        df = df[df['calc.year'] >= start_year]
+    if end_year is not None:
+        df = df[df['calc.year'] <= end_year]
+    return df
+
+
+def _load_hc(
+        base_path: Path,
+        sample_idxs: list[int] | None = None,
+        start_year: int = None,
+        end_year: int = None,
+) -> pd.DataFrame:
+    """
+    Reads the charges with calc.year in [start_year, end_year], streaming the
+    file in chunks. `sample_idxs` (row positions) parses only those rows and
+    returns them in the given order.
+    """
     hc_path = base_path / 'hc.csv'
+    if not hc_path.is_file():  # still zipped
+        hc_path = base_path / 'hc.csv.zip'
     if sample_idxs is not None:
-        return pd.read_csv(hc_path).iloc[sample_idxs]
-    else:
-        hc = pd.read_csv(hc_path, low_memory=True, skiprows=range(1, 1_200_000))
-    return hc
\ No newline at end of file
+        rows = set(sample_idxs)
+        # line 0 is the header, line i + 1 the i-th row
+        hc = _read(hc_path, skiprows=lambda i: i > 0 and i - 1 not in rows)
+        hc.index = sorted(rows)
+        return _filter_years(hc.loc[sample_idxs], start_year, end_year)
+
+    chunks = _read(hc_path, chunksize=_CHUNKSIZE)
+    hc = concat_chunks(
+        [_filter_years(chunk, start_year, end_year) for chunk in chunks])
+    return hc.reset_index(drop=True)
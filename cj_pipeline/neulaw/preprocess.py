@@ -1,15 +1,19 @@
 import pandas as pd
 from pathlib import Path
 import re
-from tqdm import tqdm
 import numpy as np
-import uuid
 
 from cj_pipeline.calculate_rais import calculate_rais
 from cj_pipeline.neulaw.load import load
 from cj_pipeline.config import logger
+from cj_pipeline.utils import map_distinct
 
 base_path = Path(__file__).parents[2] / 'data'
+defendant_groups = ['def.gender', 'def.race', 'calc.race', 'def.uid']
+# the per-charge flags only depend on these fields
+signature_cols = [
+  'calc.disp', 'offense_category', 'off.code', 'calc.broad', 'case.degree',
+  'disp.literal', 'age_cat']
 
 
 def _merge_drugs(df):
@@ -19,10 +23,9 @@ def _merge_drugs(df):
 
 def init_rai_year_range(start_year: int, end_year: int):
   logger.info("Preparing Offence Counting...")
-  df = load(base_path / 'neulaw')
+  df = load(base_path / 'neulaw', start_year=start_year)
   _merge_drugs(df)
 
-  df = df[df["calc.year"] >= start_year]
   max_year = df["calc.year"].max()
   if end_year > max_year:
     logger.warning(f"Year {end_year} is greater than max year {max_year}")
@@ -49,8 +52,6 @@ def init_rai_year_range(start_year: int, end_year: int):
 
 def preprocess(
     df: pd.DataFrame, year_start:int=-1, year_end: int=np.inf) -> pd.DataFrame:
-  tqdm.pandas()
-
   logger.info("Starting Preprocessing..")
   _merge_drugs(df)
 
@@ -66,25 +67,31 @@ def preprocess(
   logger.info("Processing age")
   df = _get_age(df)
 
+  logger.info("Indexing charges by defendant")
+  index = _defendant_index(df)
+
   logger.info("Processing last case")
-  df = _get_last_case(df)
+  df = _get_last_case(df, index)
 
   logger.info("Processing failed to appear")
   df = _get_fta(df)
 
+  logger.info("Classifying charges")
+  flags = _charge_flags(df)
+
   logger.info("Processing prior convictions")
-  df = _get_priors(df)
+  df = _get_priors(df, flags)
 
   logger.info("Processing pending charges")
-  df = _get_pending(df)
+  df = _get_pending(df, flags)
 
   logger.info("Get most serious offense")
-  df = _get_most_serious_offense(df)
+  df = _get_most_serious_offense(df, index)
 
   logger.info("Processing current charge")
-  df = _current_charge(df)
+  df = _current_charge(df, flags)
   logger.info("Processing criminal history")
-  history = _get_criminal_history(df)
+  history = _get_criminal_history(df, index)
   logger.info("Done!")
   return history
 
@@ -106,8 +113,11 @@ def _generic_preprocessing(df: pd.DataFrame, year_start: int, year_end:int) -> p
 
 
 def gen_unique_id(df) -> pd.DataFrame:
-  df['uuid'] = df.apply(lambda _: uuid.uuid4(), axis=1)
-  return df
+  """
+  Give every charge a unique row key: a contiguous integer index, which the
+  per-charge features below are aligned on (instead of merged)
+  """
+  return df.reset_index(drop=True)
 
 
 # ==================== Calculate Age ====================
@@ -120,13 +130,68 @@ def _get_age(df: pd.DataFrame) -> pd.DataFrame:
   df['age_cat'] = pd.cut(df['age'], bins=[0, 18, 31, 500], labels=['<18', '18-30', '31+'])
   return df
 
-def _age_max(age_col: pd.Series) -> pd.Series:
-  age_vals = {'<18': 0, '18-30': 1, '31+': 2}
-  age_vals_list = ["<18", "18-30", "31+"]
-  num_col = age_col.map(age_vals.get).max()
-  if isinstance(num_col, float):
-    return np.nan
-  return age_vals_list[num_col]
+
+# ==================== Defendant Index ====================
+
+def _defendant_index(df: pd.DataFrame):
+  """
+  CSR-style index of the charges, built once for all per-defendant reductions:
+  `order` sorts the charges by `def.uid` and then by `defendant_groups`, so the
+  charges of the i-th defendant group are `order[starts[i]:starts[i + 1]]`
+  and those of the j-th `def.uid` are `order[uid_starts[j]:uid_starts[j + 1]]`.
+  `codes` are the group numbers (in key order) of every charge, -1 for missing
+  keys; charges without a `def.uid` are left out, as in a groupby.
+  """
+  uid = df.groupby("def.uid").ngroup().fillna(-1).to_numpy(int)
+  codes = df.groupby(defendant_groups).ngroup().fillna(-1).to_numpy(int)
+  order = np.lexsort((codes, uid))  # stable: ties stay in row order
+  order = order[uid[order] >= 0]
+  uid_starts = _segment_starts(uid[order])
+  starts = _segment_starts(uid[order], codes[order])
+  return order, starts, uid_starts, codes
+
+
+def _segment_starts(*keys: np.ndarray) -> np.ndarray:
+  change = np.zeros(len(keys[0]), dtype=bool)
+  change[:1] = True
+  for key in keys:
+    change[1:] |= key[1:] != key[:-1]
+  return np.flatnonzero(change)
+
+
+def _reduce(col: pd.Series, order: np.ndarray, starts: np.ndarray, how: str):
+  """
+  Reduces `col` over the contiguous slices of a defendant index, skipping
+  missing values as a groupby does
+  """
+  if how == "sum":
+    return np.add.reduceat(col.fillna(0).to_numpy(int)[order], starts)
+  if how == "min":
+    return np.fmin.reduceat(col.to_numpy(float)[order], starts)
+  if how == "max":  # missing values (code -1, NaT) compare smallest
+    if isinstance(col.dtype, pd.CategoricalDtype):
+      codes = np.maximum.reduceat(col.cat.codes.to_numpy()[order], starts)
+      values = pd.Categorical.from_codes(codes, dtype=col.dtype)
+      return values.astype(object)
+    values = col.to_numpy("datetime64[ns]").view("i8")
+    return np.maximum.reduceat(values[order], starts).view("datetime64[ns]")
+  if how == "first":  # first non-missing value in row order
+    rows = np.where(col.notna().to_numpy()[order], order, len(col))
+    rows = np.minimum.reduceat(rows, starts)
+    return col.reset_index(drop=True).reindex(rows).to_numpy()
+  raise ValueError(f"Unknown reduction {how}")
+
+
+def _argmax(values: np.ndarray, order: np.ndarray, starts: np.ndarray):
+  """
+  Row of the largest value in every slice of a defendant index, the first
+  such row on ties (as `idxmax`)
+  """
+  values = values[order]
+  largest = np.repeat(
+    np.maximum.reduceat(values, starts), np.diff(starts, append=len(order)))
+  rows = np.where(values == largest, order, np.iinfo(order.dtype).max)
+  return np.minimum.reduceat(rows, starts)
 
 # ==================== Calculate Failed To Appear ====================
 
@@ -139,20 +204,14 @@ def _count_offense(df: pd.DataFrame) -> pd.DataFrame:
   offense_dict = {_to_colname(offense_type): _n_offense(offense_type) for offense_type in offense_types}
   return pd.DataFrame(offense_dict)
 
-def _get_last_case(df: pd.DataFrame):
+def _get_last_case(df: pd.DataFrame, index):
   """
   Get the last case date for each defendant
   """
-
-  def _last(group):
-    return group.idxmax()
-
-  tqdm.pandas(desc='Getting last cases')
-  # with logging_redirect_tqdm():#
+  order, _, uid_starts, _ = index
   # only take with latest 'case.dt'
-  # last_rows = df.groupby("def.uid")["case.dt"].idxmax()
-  last_rows = df.groupby("def.uid")["case.dt"].progress_apply(_last)
-  last_df = df.loc[last_rows]
+  case_dt = df["case.dt"].to_numpy("datetime64[ns]").view("i8")
+  last_df = df.iloc[_argmax(case_dt, order, uid_starts)]
   last_df = last_df.rename(
     {
       "calc.casenr": "last.case",
@@ -160,7 +219,7 @@ def _get_last_case(df: pd.DataFrame):
       "off.date": "last.off.date"
     }, axis=1)
   last_df = last_df[["def.uid", "last.case", "last.case.dt", "last.off.date"]]
-  df = df.merge(last_df, on="def.uid", how="left")
+  df = df.join(last_df.set_index("def.uid"), on="def.uid")
   df["diff"] = (df["last.off.date"] - df["off.date"]).dt.days
   return df
 
@@ -172,32 +231,37 @@ def _get_fta(df: pd.DataFrame) -> pd.DataFrame:
   """
   offense_codes = ["501201", "501202", "820772", "820156", "500201", "500202"]
 
-  prior_df = df[df["diff"] > 0][["uuid", "diff", "off.code"]]
+  prior_df = df[df["diff"] > 0][["diff", "off.code"]]
 
   offense_cond = prior_df["off.code"].isin(offense_codes)
 
   prior_df["fta_lt_2yr"] = (offense_cond) & (prior_df["diff"] < 365.25 * 2)
   prior_df["fta_gt_2yr"] = (offense_cond) & (prior_df["diff"] >= 365.25 * 2)
 
-  prior_df = prior_df.drop(["diff", "off.code"], axis=1)
-  df = df.merge(prior_df, on=["uuid"], how="left")
-  df = df.fillna({"fta_lt_2yr": False, "fta_gt_2yr": False})
+  for col in ["fta_lt_2yr", "fta_gt_2yr"]:
+    df[col] = prior_df[col].reindex(df.index, fill_value=False)
   return df
 
 
 # =================== Calculate Priors ===================
 
 
-def _drug_conviction(row):
-  if "Guilty" in row["calc.disp"] and row["offense_category"] == "drugs":
-    return True
-  return False
+def _drug_conviction(df: pd.DataFrame) -> pd.Series:
+  guilty = df["calc.disp"].str.contains("Guilty", regex=False, na=False)
+  return guilty & (df["offense_category"] == "drugs")
 
-def _match_charge(tuple, charge, degree):
-  return tuple[0] == charge and re.search(tuple[1], degree) is not None
+def _search(col: pd.Series, pattern: str) -> pd.Series:
+  """
+  Whether `re.search(pattern, value)` finds a match, once per distinct value
+  """
+  found = map_distinct(
+    col, lambda value: re.search(pattern, value) is not None, dtype="boolean")
+  return found.fillna(False).astype(bool)
 
 
-def _violent_conviction(row, pending: bool = False, age_condition: bool = False):
+def _violent_conviction(
+    df: pd.DataFrame, pending: bool = False, age_condition: bool = False
+) -> pd.Series:
   charge_degrees = [
     ("Arson", "F1"),
     ("Assault - Nonsexual", "F2|F3|FS|MA"),
@@ -210,44 +274,59 @@ def _violent_conviction(row, pending: bool = False, age_condition: bool = False)
     ("Sexual Assault")
   ]
   other_charges = "360112|110551|110549|110550|360115|360116|360111|110934|110533|110425|110625|110825|111025|111225|111425|110426|369998|369995|369996"
-  if pending or "Guilty" in row["calc.disp"]:
-    if not age_condition or row["age_cat"] != '<18':
-      return re.search(other_charges, row["off.code"]) is not None or any([_match_charge(c, row["calc.broad"], row["case.degree"]) for c in charge_degrees])
-  return False
-
-def _incarceration(row):
+  violent = _search(df["off.code"], other_charges)
+  for charge_degree in charge_degrees:
+    # ("Sexual Assault") is a plain string rather than a pair, so it compares
+    # 'calc.broad' to "S" and never matches (kept as it was)
+    violent |= (
+      (df["calc.broad"] == charge_degree[0])
+      & _search(df["case.degree"], charge_degree[1]))
+  if not pending:
+    violent &= df["calc.disp"].str.contains("Guilty", regex=False, na=False)
+  if age_condition:
+    violent &= df["age_cat"] != '<18'
+  return violent
+
+def _incarceration(df: pd.DataFrame) -> pd.Series:
   sentences = "COMMITTED TO LOCAL JAIL|COMMITTED TO TDC|STATE JAIL|LIFE SENTENCE|SHOCK PROBATION"
-  return re.search(sentences, row["disp.literal"]) is not None
+  return _search(df["disp.literal"], sentences)
 
-def _get_priors(df: pd.DataFrame) -> pd.DataFrame:
+def _charge_flags(df: pd.DataFrame) -> pd.DataFrame:
   """
-  Get the number of priors for each defendant
+  Classify every charge: the flags are evaluated once per distinct signature
+  (combination of `signature_cols`) and broadcast back to the charges
   """
-  prior_df = df[(df["diff"] > 0) | (df["diff"].isna())].copy()
-
-  # Priors
-  tqdm.pandas(desc='Counting drug convictions')
-  prior_df["drug.conviction"] = prior_df.progress_apply(_drug_conviction, axis=1)
-
-  tqdm.pandas(desc='Counting violent convictions')
-  prior_df["violent.conviction"] = prior_df.progress_apply(_violent_conviction, axis=1)
-
-  tqdm.pandas(desc='Counting violent convictions (adult)')
-  prior_df["violent.conviction.adult"] = prior_df.progress_apply(_violent_conviction, age_condition=True, axis=1)
-
-  tqdm.pandas(desc='Counting incarcerations')
-  prior_df["incarceration"] = prior_df.progress_apply(_incarceration, axis=1)
-
-  prior_df["conviction"] = prior_df["calc.disp"].str.contains("Guilty")
-
-  prior_df["not.dismissed"] = prior_df["calc.disp"] != "Dismissal"
+  keys = np.column_stack([pd.factorize(df[col])[0] for col in signature_cols])
+  _, first, codes = np.unique(
+    keys, axis=0, return_index=True, return_inverse=True)
+  charges = df.iloc[first]
+  flags = pd.DataFrame({
+    "drug.conviction": _drug_conviction(charges),
+    "violent.conviction": _violent_conviction(charges),
+    "violent.conviction.adult": _violent_conviction(charges, age_condition=True),
+    "violent.pending": _violent_conviction(charges, pending=True),
+    "incarceration": _incarceration(charges),
+    "conviction": charges["calc.disp"].str.contains("Guilty", na=False),
+    "not.dismissed": charges["calc.disp"] != "Dismissal",
+    "misdemeanor": charges["case.degree"].str.contains("M", na=False),
+    "felony": charges["case.degree"].str.contains("F", na=False),
+  })
+  return flags.iloc[codes.ravel()].set_axis(df.index)
 
-  prior_df["misdemeanor"] = prior_df["case.degree"].str.contains("M")
+def _flag(flags: pd.DataFrame, col: str, rows: pd.Series) -> pd.Series:
+  """
+  The `col` flag of the charges in `rows`, False elsewhere; a missing flag
+  (e.g. `str.contains` on a missing degree) is False too
+  """
+  return flags[col].fillna(False).astype(bool) & rows
 
-  prior_df["felony"] = prior_df["case.degree"].str.contains("F")
+def _get_priors(df: pd.DataFrame, flags: pd.DataFrame) -> pd.DataFrame:
+  """
+  Get the number of priors for each defendant
+  """
+  prior = (df["diff"] > 0) | (df["diff"].isna())
 
-  prior_df = prior_df[[
-    'uuid',
+  prior_cols = [
     'drug.conviction',
     'violent.conviction',
     'violent.conviction.adult',
@@ -255,66 +334,35 @@ def _get_priors(df: pd.DataFrame) -> pd.DataFrame:
     'conviction',
     'not.dismissed',
     'misdemeanor',
-    'felony']]
-
-  df = df.merge(prior_df, on="uuid", how="left")
-
-  df = df.fillna({
-    "drug.conviction": False,
-    "violent.conviction": False,
-    "violent.conviction.adult": False,
-    "incarceration": False,
-    "conviction": False,
-    "not.dismissed": False,
-    "misdemeanor": False,
-    "felony": False
-  })
+    'felony']
+
+  for col in prior_cols:
+    df[col] = _flag(flags, col, prior)
 
   return df
 
 #  =================== Calculate Pending Charges ===================
 
-def _get_pending(df: pd.DataFrame) -> pd.DataFrame:
+def _get_pending(df: pd.DataFrame, flags: pd.DataFrame) -> pd.DataFrame:
 
   # Only prior cases
-  prior_df = df[(df["diff"] > 0) | (df["diff"].isna())].copy()
+  prior = (df["diff"] > 0) | (df["diff"].isna())
   # Only pending cases
-  pending_df = prior_df[(prior_df["last.off.date"] - prior_df["disp.date"]).dt.days < 0]
-
-
-  pending_df["violent.pending"] = pending_df.progress_apply(_violent_conviction, pending=True, axis=1)
-  pending_df["pending.charge"] = True
+  pending = prior & ((df["last.off.date"] - df["disp.date"]).dt.days < 0)
 
-  pending_df = pending_df[["uuid", "violent.pending", "pending.charge"]]
-
-  df = df.merge(pending_df, on="uuid", how="left")
-  df["pending.charge"] = df["pending.charge"].fillna(False)
-  df["violent.pending"] = df["violent.pending"].fillna(False)
+  df["violent.pending"] = _flag(flags, "violent.pending", pending)
+  df["pending.charge"] = pending
 
   return df
 
-def _current_charge(df: pd.DataFrame) -> pd.DataFrame:
-
-  current_df = df[df["diff"] == 0].copy()
-
-  current_df["current.felony"] = current_df["case.degree"].str.contains("F")
-  current_df["current.violent"] = current_df.apply(_violent_conviction, pending=True, axis=1)
-  current_df["current.conviction"] = current_df["calc.disp"].str.contains("Guilty")
-  current_df["current.age.numeric"] = current_df["age"]
+def _current_charge(df: pd.DataFrame, flags: pd.DataFrame) -> pd.DataFrame:
 
-  current_df = current_df[[
-    "uuid",
-    "current.felony",
-    "current.violent",
-    "current.conviction",
-    "current.age.numeric",
-  ]]
+  current = df["diff"] == 0
 
-  df = df.merge(current_df, on=["uuid"], how="left")
-
-  df["current.felony"] = df["current.felony"].fillna(False)
-  df["current.violent"] = df["current.violent"].fillna(False)
-  df["current.conviction"] = df["current.conviction"].fillna(False)
+  df["current.felony"] = _flag(flags, "felony", current)
+  df["current.violent"] = _flag(flags, "violent.pending", current)
+  df["current.conviction"] = _flag(flags, "conviction", current)
+  df["current.age.numeric"] = df["age"].where(current)
 
   return df
 
@@ -325,71 +373,60 @@ def _get_most_serious_offense_degree(df: pd.DataFrame) -> pd.DataFrame:
   """
   Get the most serious offense for each defendant
   """
-  def _degree(degree):
-    match degree:
-      case _ if degree == "M":
-        return 2
-      case _ if degree == "MA":
-        return 3
-      case _ if degree == "MB":
-        return 2
-      case _ if degree == "MC":
-        return 1
-      case _ if degree == "FS":
-        return 4
-      case _ if degree == "F3":
-        return 5
-      case _ if degree == "F2":
-        return 6
-      case _ if degree == "F1":
-        return 7
-      case _ if degree == "FC":
-        return 8
-      case _ if degree == "F":
-        return 6
-      case _:
-        return 0
-  tqdm.pandas(desc='Calculating degree of offense')
-  df["degree_num"] = df['case.degree'].progress_apply(_degree)
+  degrees = {
+    "M": 2, "MA": 3, "MB": 2, "MC": 1,
+    "FS": 4, "F3": 5, "F2": 6, "F1": 7, "FC": 8, "F": 6}
+  # other (and missing) degrees rank lowest
+  df["degree_num"] = map_distinct(
+    df['case.degree'], lambda degree: degrees.get(degree, 0),
+    dtype=pd.Int64Dtype()).fillna(0).astype(int)
   return df
 
-def _get_most_serious_offense(df: pd.DataFrame):
-  groups = ['def.gender', 'def.race', 'calc.race', 'def.uid']
+def _get_most_serious_offense(df: pd.DataFrame, index):
   df = _get_most_serious_offense_degree(df)
-  def _most_serious_offense(group):
-    return group["calc.detailed"][group["degree_num"] == group["degree_num"].max()].iloc[0]
-  srs_off = df.groupby(groups).progress_apply(_most_serious_offense)
-  srs_off = srs_off.to_frame("most_serious_offense").reset_index()
-  df = df.merge(srs_off, on=groups, how="left")
+  order, starts, _, codes = index
+  # the first charge with the highest degree, per defendant group
+  rows = _argmax(df["degree_num"].to_numpy(), order, starts)
+  offense = df["calc.detailed"].to_numpy(object)[rows]
+  offense = np.repeat(offense, np.diff(starts, append=len(order)))
+  keep = codes[order] >= 0  # no groups for missing keys
+  most_serious = pd.Series(np.nan, index=df.index, dtype=object)
+  most_serious.iloc[order[keep]] = offense[keep]
+  df["most_serious_offense"] = most_serious
   return df
 
 
-def _get_criminal_history(df: pd.DataFrame) -> pd.DataFrame:
-  groups = ['def.gender', 'def.race', 'calc.race', 'def.uid']
-  agg = df.groupby(groups).agg(
-    {
-      "age_cat": _age_max,
-      "case.dt": "max",
-      "fta_lt_2yr": "sum",
-      "fta_gt_2yr": "sum",
-      "drug.conviction": "sum",
-      "violent.conviction": "sum",
-      "violent.conviction.adult": "sum",
-      "incarceration": "sum",
-      "conviction": "sum",
-      "not.dismissed": "sum",
-      "misdemeanor": "sum",
-      "felony": "sum",
-      "age": "min",
-      "violent.pending": "sum",
-      "pending.charge": "sum",
-      "current.felony": "first",
-      "current.violent": "first",
-      "current.conviction": "first",
-      "current.age.numeric": "first",
-      "most_serious_offense": "first"
-    }
-  ).reset_index()
+def _get_criminal_history(df: pd.DataFrame, index) -> pd.DataFrame:
+  order, starts, _, codes = index
+  # one row per defendant group in key order, groups with missing keys dropped
+  first = order[starts]
+  segments = np.flatnonzero(codes[first] >= 0)
+  segments = segments[np.argsort(codes[first[segments]])]
+  agg = df[defendant_groups].iloc[first[segments]].reset_index(drop=True)
+  reductions = {
+    "age_cat": "max",
+    "case.dt": "max",
+    "fta_lt_2yr": "sum",
+    "fta_gt_2yr": "sum",
+    "drug.conviction": "sum",
+    "violent.conviction": "sum",
+    "violent.conviction.adult": "sum",
+    "incarceration": "sum",
+    "conviction": "sum",
+    "not.dismissed": "sum",
+    "misdemeanor": "sum",
+    "felony": "sum",
+    "age": "min",
+    "violent.pending": "sum",
+    "pending.charge": "sum",
+    "current.felony": "first",
+    "current.violent": "first",
+    "current.conviction": "first",
+    "current.age.numeric": "first",
+    "most_serious_offense": "first"
+  }
+  for col, how in reductions.items():
+    agg[col] = _reduce(df[col], order, starts, how)[segments]
   # offenses = df.groupby(groups).apply(_count_offense)
   # df = agg.merge(offenses, on='def.uid', how='left')
 
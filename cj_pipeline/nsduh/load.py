@@ -1,30 +1,174 @@
+import functools
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from typing import Iterable
+from concurrent.futures import ProcessPoolExecutor
 from cj_pipeline.nsduh.preprocess import get_variables
+from cj_pipeline.utils import concat_chunks, read_cached, storable_categories
 
 years = range(1992, 2020)
 stata_years = [1999, 2000, 2001]
 data_path = Path(__file__).parents[2] / 'data' / 'nsduh'
+_CACHE_VERSION = 2  # bump whenever the readers below change their output
+_CHUNKSIZE = 100_000
 
 
-def read_nsduh(year: int, max_rows: int = None) -> pd.DataFrame:
+def _iter_stata(path: Path, max_rows: int = None, chunksize: int = _CHUNKSIZE):
+  """Yields the projected variables `chunksize` rows at a time.
+
+  The variable names come from the header and each chunk is downcast before
+  the next one is read, so the full-width file is never held in memory.
+  """
+  n_read = 0
+  variables = get_variables()
+  with pd.read_stata(path, iterator=True) as reader:
+    columns = [c for c in reader.variable_labels() if c in variables]
+    while max_rows is None or n_read < max_rows:
+      nrows = chunksize if max_rows is None else min(chunksize, max_rows - n_read)
+      try:
+        chunk = reader.read(nrows, columns=columns)
+      except StopIteration:  # all rows read
+        break
+      if len(chunk) == 0:
+        break
+      yield _downcast(chunk)
+      n_read += len(chunk)
+
+
+def _iter_tab(path: Path, chunksize: int = _CHUNKSIZE):
+  yield from pd.read_csv(
+    path, sep='\t', usecols=lambda c: c in get_variables(), chunksize=chunksize)
+
+
+def _downcast(df: pd.DataFrame) -> pd.DataFrame:
+  for col in df.columns:
+    kind = df[col].dtype.kind
+    if kind in 'iu':
+      df[col] = pd.to_numeric(df[col], downcast='integer')
+    elif kind == 'f':
+      df[col] = pd.to_numeric(df[col], downcast='float')
+  return df
+
+
+def _sample_chunks(
+    chunks: Iterable[pd.DataFrame],
+    sample_frac: float = None,
+    sample_n: int = None,
+    seed=0,
+) -> pd.DataFrame:
+  """Random subset of the streamed rows, returned in file order.
+
+  Every row draws a uniform key: `sample_frac` keeps the rows whose key is
+  below it (Bernoulli sampling), `sample_n` keeps the `sample_n` smallest
+  keys seen so far (a reservoir, i.e., sampling without replacement). The
+  keys are drawn in file order, so the sample does not depend on chunking.
+  """
+  rng = np.random.default_rng(seed)
+  sample, keys = [], pd.Series(dtype=float)
+  for chunk in chunks:  # chunk indices are the row positions in the file
+    chunk_keys = pd.Series(rng.random(len(chunk)), index=chunk.index)
+    if sample_frac is not None:
+      sample.append(chunk[chunk_keys.to_numpy() < sample_frac])
+      continue
+    if len(keys) == sample_n:  # only smaller keys can enter the reservoir
+      chunk_keys = chunk_keys[chunk_keys < keys.max()]
+    keys = pd.concat([keys, chunk_keys]).nsmallest(sample_n)
+    sample = [df[df.index.isin(keys.index)] for df in sample + [chunk]]
+  return concat_chunks(sample).sort_index().reset_index(drop=True)
+
+
+def _read(
+    path: Path,
+    max_rows: int = None,
+    sample_frac: float = None,
+    sample_n: int = None,
+    seed=0,
+) -> pd.DataFrame:
+  sampled = sample_frac is not None or sample_n is not None
+  if path.suffix != '.dta' and not sampled:  # read in one go
+    kwargs = {'nrows': max_rows} if max_rows is not None else {}
+    return pd.read_csv(
+      path, sep='\t', usecols=lambda c: c in get_variables(), **kwargs)
+
+  if path.suffix == '.dta':
+    chunks = _iter_stata(path, max_rows)
+  else:
+    chunks = _iter_tab(path)
+  if sampled:
+    return _sample_chunks(chunks, sample_frac, sample_n, seed)
+  return concat_chunks(list(chunks)).reset_index(drop=True)
+
+
+def read_nsduh(
+    year: int,
+    max_rows: int = None,
+    use_cache: bool = True,
+    sample_frac: float = None,
+    sample_n: int = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+  """Reads one survey year, optionally a subset of it.
+
+  `max_rows` takes the first rows of the file; `sample_frac` and `sample_n`
+  take a reproducible random subset instead (see `_sample_chunks`), drawn
+  with a seed derived from `seed` and `year`.
+  """
+  if sum(arg is not None for arg in (max_rows, sample_frac, sample_n)) > 1:
+    raise ValueError(
+      'At most one of max_rows, sample_frac and sample_n can be given.')
+  if sample_frac is not None and not 0 < sample_frac <= 1:
+    raise ValueError(f'sample_frac must be in (0, 1], got {sample_frac}.')
+  if sample_n is not None and sample_n < 1:
+    raise ValueError(f'sample_n must be positive, got {sample_n}.')
+
   if year in stata_years:
     path = data_path / f'NHSDA-{year}-DS0001-data-stata.dta'
-    kwargs = {'iterator': True, 'chunksize': max_rows}
-    reader = pd.read_stata(path, **kwargs)  # used to get available var names
-    kwargs['columns'] = list(
-      get_variables().intersection(reader.variable_labels().keys()))
-    df = next(pd.read_stata(path, **kwargs))   # take just the first max_rows
   else:
     path = data_path / f'NSDUH_{year}_Tab.txt'
-    kwargs = {'nrows': max_rows} if max_rows is not None else {}
-    df = pd.read_csv(
-      path, sep='\t', usecols=lambda c: c in get_variables(), **kwargs)
+  subset = {'max_rows': max_rows, 'sample_frac': sample_frac,
+            'sample_n': sample_n}
+  if sample_frac is not None or sample_n is not None:
+    subset['seed'] = [seed, year]
+  read_fn = functools.partial(_read, path, **subset)
+
+  if use_cache:  # keyed by the source file and the requested subset
+    key = (_CACHE_VERSION, sorted(get_variables()), sorted(subset.items()))
+    df = read_cached(read_fn, path, key=key)
+  else:  # as `read_cached` stores it
+    df = storable_categories(read_fn())
 
   df['YEAR'] = year
   return df
 
 
-def load_nsduh(max_rows: int = None) -> pd.DataFrame:
-  df = pd.concat([read_nsduh(year, max_rows) for year in years])
+def iter_nsduh(max_rows: int = None, use_cache: bool = True, **sample):
+  """Yields the survey years one at a time, in year order.
+
+  `sample` (`sample_frac`, `sample_n`, `seed`) is passed to `read_nsduh`.
+  """
+  for year in years:
+    yield read_nsduh(year, max_rows, use_cache, **sample)
+
+
+def load_nsduh(
+    max_rows: int = None,
+    n_workers: int = 1,
+    use_cache: bool = True,
+    **sample,
+) -> pd.DataFrame:
+  """Reads all survey years and concatenates them in year order.
+
+  With `n_workers > 1` the (independent) years are read in a process pool.
+  `sample` (`sample_frac`, `sample_n`, `seed`) is passed to `read_nsduh`;
+  `sample_n` rows are drawn from every year, i.e., stratified by year.
+  """
+  read_fn = functools.partial(
+    read_nsduh, max_rows=max_rows, use_cache=use_cache, **sample)
+  if n_workers is not None and n_workers <= 1:
+    dfs = [read_fn(year) for year in years]
+  else:  # `n_workers=None` -> one worker per core
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+      dfs = list(executor.map(read_fn, years))
+  df = pd.concat(dfs)
   return df
@@ -1,26 +1,35 @@
+import re
 import tqdm
-import itertools
-import functools
 import numpy as np
 import pandas as pd
 
 from cj_pipeline.config import logger, SMOOTHING
-from cj_pipeline.utils import smooth_arrest_rates
-
-from typing import List, Dict
-
-
-def _sdiv(a, b):
-  return a / b if b != 0 else 0
-
-
-def _nan_value(entry):
-  return entry if pd.notna(entry) else None
-
-
-def _categorical_to_object_col(df, name):
-  if df[name].dtype.name == 'category':
-    df[name] = df[name].astype(object)
+from cj_pipeline.utils import (
+  expand_grid, map_distinct, memory_report, smooth_arrest_rates_all)
+
+from typing import Dict, Iterable, List
+
+
+def _recode(df, name, rules):
+  """Recodes the survey labels of `name` into integer codes.
+
+  `rules` are `(labels, code)` pairs tried in order: a label matches if it is
+  in `labels`, or if `labels` is a compiled regex found in the label. Labels
+  matching no rule are coerced to numbers (i.e., any other string is NaN).
+  Each rule is resolved once per distinct label, not once per respondent.
+  """
+  def _code(label):
+    if isinstance(label, str):
+      for labels, code in rules:
+        if isinstance(labels, re.Pattern):
+          if labels.search(label) is not None:
+            return code
+        elif label in labels:
+          return code
+    return pd.to_numeric(label, errors='coerce')
+
+  df[name] = map_distinct(df[name], _code, dtype=pd.Int32Dtype())
+  return df
 
 
 def process_integer(df, name):
@@ -29,112 +38,84 @@ def process_integer(df, name):
 
 
 def process_newrace2(df, name):
-  df[name].replace('NonHisp White', 1, inplace=True)
-  df[name].replace('NonHisp Black/Afr Am', 2, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+  return _recode(df, name, [
+    ({'NonHisp White'}, 1),
+    ({'NonHisp Black/Afr Am'}, 2),
+  ])
 
 
 def process_catag3(df, name):
-  df.replace({
-    name: {
-      '12-17 Years Old': 1,
-      '18-25 Years Old': 2,
-      '26-34 Years Old': 3,
-      '35-49 Years Old': 4,
-      '50 or Older': 5
-    }
-  }, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+  return _recode(df, name, [
+    ({'12-17 Years Old'}, 1),
+    ({'18-25 Years Old'}, 2),
+    ({'26-34 Years Old'}, 3),
+    ({'35-49 Years Old'}, 4),
+    ({'50 or Older'}, 5),
+  ])
 
 
 def process_dui_like(df, name):
-  _categorical_to_object_col(df, name)
-
-  df[name].replace('Yes', 1, inplace=True)
-  df[name].replace(
-    regex=[
+  return _recode(df, name, [
+    ({'Yes'}, 1),
+    (re.compile('|'.join([
       'No', 'No .*', 'LEGITIMATE SKIP', 'LEGITIMATE SKIP Logically assigned',
-      'NEVER USED ALCOHOL OR DRUGS', 'NEVER USED ALCOHOL OR DRUGS Logically assigned'],
-    value=2, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+      'NEVER USED ALCOHOL OR DRUGS',
+      'NEVER USED ALCOHOL OR DRUGS Logically assigned'])), 2),
+  ])
 
 
 def process_drug_sell(df, name):
-  _categorical_to_object_col(df, name)
-
-  df[name].replace(
-    ['1 or 2 times', '3 to 5 times', '6 to 9 times', '10 or more times'],
-    2, inplace=True)
-  df[name].replace(
-    ['0 times', 'LEGITIMATE SKIP', 'LEGITIMATE SKIP Logically assigned'],
-    1, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+  return _recode(df, name, [
+    ({'1 or 2 times', '3 to 5 times', '6 to 9 times', '10 or more times'}, 2),
+    ({'0 times', 'LEGITIMATE SKIP', 'LEGITIMATE SKIP Logically assigned'}, 1),
+  ])
 
 
 def process_bkdrug(df, name):
-  _categorical_to_object_col(df, name)
-
-  df[name].replace(['Yes', 'Yes LOGICALLY ASSIGNED'], 1, inplace=True)
-  df[name].replace(['No', 'LEGITIMATE SKIP'], 2, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+  return _recode(df, name, [
+    ({'Yes', 'Yes LOGICALLY ASSIGNED'}, 1),
+    ({'No', 'LEGITIMATE SKIP'}, 2),
+  ])
 
 
 def process_bkdrvinf(df, name):
-  _categorical_to_object_col(df, name)
+  return _recode(df, name, [
+    ({'Yes', 'Yes LOGICALLY ASSIGNED'}, 1),
+    ({'No', 'LEGITIMATE SKIP'}, 2),
+  ])
 
-  df[name].replace(['Yes', 'Yes LOGICALLY ASSIGNED'], 1, inplace=True)
-  df[name].replace(['No', 'LEGITIMATE SKIP'], 2, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
 
 def process_booked(df, name):
-  _categorical_to_object_col(df, name)
+  return _recode(df, name, [
+    ({'Yes', 'Yes LOGICALLY ASSIGNED',
+      'Yes LOGICALLY ASSIGNED (PROBATON OR PAROLE=1)'}, 1),
+    ({'No', 'LEGITIMATE SKIP'}, 2),
+  ])
 
-  df[name].replace(['Yes', 'Yes LOGICALLY ASSIGNED',
-                    'Yes LOGICALLY ASSIGNED (PROBATON OR PAROLE=1)'], 1, inplace=True)
-  df[name].replace(['No', 'LEGITIMATE SKIP'], 2, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
 
 def process_nobooky2(df, name):
-  _categorical_to_object_col(df, name)
-
-  df[name].replace(['One time', 'Two times', 'Three or more times'], 1, inplace=True)
-  df[name].replace(['None', 'LEGITIMATE SKIP',
-                    'LEGITIMATE SKIP (BOOKED=2)'], 0, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+  return _recode(df, name, [
+    ({'One time', 'Two times', 'Three or more times'}, 1),
+    ({'None', 'LEGITIMATE SKIP', 'LEGITIMATE SKIP (BOOKED=2)'}, 0),
+  ])
 
 
 def process_drugmon(df, name):
-  _categorical_to_object_col(df, name)
-
-  df[name].replace(inplace=True, regex={
-    'Used within the past month .*': 1, 'Did not use in the past month .*': 0
-  })
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+  return _recode(df, name, [
+    (re.compile('Used within the past month .*'), 1),
+    (re.compile('Did not use in the past month .*'), 0),
+  ])
 
 
 def process_hallrec(df, name):
-  _categorical_to_object_col(df, name)
-
-  df[name].replace([
-    'Within the past 30 days', 'Used in the past 30 days LOGICALLY ASSIGNED'],
-    1, inplace=True)
-  df[name].replace([
-    'NEVER USED HALLUCINOGENS',
-    'More than 30 days ago but within the past 12 mos',
-    'Used >30 days ago but within pst 12 mos LOG ASSN',
-    'More than 12 months ago'],
-    0, inplace=True)
-  df[name] = pd.to_numeric(df[name], errors='coerce')  # set all else to NaN
-  return process_integer(df, name)
+  return _recode(df, name, [
+    ({'Within the past 30 days',
+      'Used in the past 30 days LOGICALLY ASSIGNED'}, 1),
+    ({'NEVER USED HALLUCINOGENS',
+      'More than 30 days ago but within the past 12 mos',
+      'Used >30 days ago but within pst 12 mos LOG ASSN',
+      'More than 12 months ago'}, 0),
+  ])
 
 
 def process_irsex(df, name):
@@ -210,333 +191,360 @@ def get_variables():
     return set(variable_pp.keys())
 
 
+def _is_in(df, name, values):
+  # missing values never match any of the values
+  return df[name].isin(values).to_numpy(dtype=bool, na_value=False)
+
+
 def add_race(df):
-  def _process(row):
-    if _nan_value(row['NEWRACE2']) == 7 or _nan_value(row['IRHOIND']) == 1:
-      return 'Hispanic'
-    if _nan_value(row['NEWRACE2']) == 1 or _nan_value(row['IRRACE']) == 4:
-      return 'White'
-    if _nan_value(row['NEWRACE2']) == 2 or _nan_value(row['IRRACE']) == 3:
-      return 'Black'
-    return None
-
-  df['offender_race'] = df.apply(_process, axis=1)
+  race = np.select(
+    [
+      _is_in(df, 'NEWRACE2', [7]) | _is_in(df, 'IRHOIND', [1]),
+      _is_in(df, 'NEWRACE2', [1]) | _is_in(df, 'IRRACE', [4]),
+      _is_in(df, 'NEWRACE2', [2]) | _is_in(df, 'IRRACE', [3]),
+    ],
+    ['Hispanic', 'White', 'Black'],
+    default=None,
+  )
+
+  df['offender_race'] = pd.Series(race, index=df.index)
   df = df.dropna(subset=['offender_race'], axis=0)
   df = df.drop(columns=['NEWRACE2', 'IRRACE'], errors='ignore')
   return df
 
 
 def add_age(df):
-  def _process(row):
-    if _nan_value(row['CATAG3']) == 1:
-      return '< 18'
-    if _nan_value(row['CATAG3']) in {2, 3}:
-      return '18-34'
-    if _nan_value(row['CATAG3']) in {4, 5}:
-      return '> 34'
-    # if row['CATAG7'] in {1, 2, 3}:
-    #   return '< 18'
-    # if row['CATAG7'] in {4, 5, 6}:
-    #   return '18-30'
-    # if row['CATAG6'] in {4, 5, 6}:
-    #   return '> 30'
-    return None
-
-  df['offender_age'] = df.apply(_process, axis=1)
+  age = np.select(
+    [
+      _is_in(df, 'CATAG3', [1]),
+      _is_in(df, 'CATAG3', [2, 3]),
+      _is_in(df, 'CATAG3', [4, 5]),
+      # _is_in(df, 'CATAG7', [1, 2, 3]),  -> '< 18'
+      # _is_in(df, 'CATAG7', [4, 5, 6]),  -> '18-30'
+      # _is_in(df, 'CATAG6', [4, 5, 6]),  -> '> 30'
+    ],
+    ['< 18', '18-34', '> 34'],
+    default=None,
+  )
+
+  df['offender_age'] = pd.Series(age, index=df.index)
   df = df.dropna(subset=['offender_age'], axis=0)
   df = df.drop(columns=['CATAG3', 'CATAG6', 'CATAG7'], errors='ignore')
   return df
 
 
+_DUI_GRP0 = ('DRVINALCO2', 'DRVINMARJ2', 'DRVINDRG', 'DRVINDROTMJ', 'DRVINALDRG')
+_DUI_GRP1 = ('DRVALDR', 'DRVAONLY', 'DRVDONLY')
+_DUI_GRP2 = ('DRUNKDRV', 'DRDRVUN', 'DRIVEAL', 'DRIVEDR')
+_SELL_GRP0 = ('YEYSELL', 'SNYSELL')
+_SELL_GRP1 = ('SOLDDRUG',)
+_USE_GRP0 = (
+  'MRJMON', 'COCMON', 'CRKMON', 'HERMON', 'HALLUCMON', 'LSDMON', 'PCPMON',
+  'ECSTMOMON', 'DAMTFXMON', 'KETMINMON', 'SALVIAMON', 'INHALMON', 'METHAMMON')
+_USE_GRP1 = ('HALLREC',)
+_BOOKED_12 = range(1, 21)  # NOBOOKY2: no. of times booked in the past year
+
+# Derived outcomes, in order of evaluation (later rules may use earlier
+# outcomes). Each outcome is a list of `(conditions, result)` clauses; a
+# clause holds if for each `(columns, values)` condition any of the columns
+# takes one of the values. The first clause that holds gives the outcome,
+# otherwise it is None.
+DUI_RULES = {
+  'dui': [
+    ([(_DUI_GRP0 + _DUI_GRP1, {1})], True),
+    ([(_DUI_GRP2, {1, 3})], True),
+    ([(_DUI_GRP0, {0})], False),
+    ([(_DUI_GRP1, {2, 81, 91, 99})], False),
+    ([(_DUI_GRP2, {2})], False),
+  ],
+  'dui_arrests': [
+    ([(('BKDRVINF',), {1, 3})], True),
+    ([(('BKOTHOFF',), {10})], True),
+    ([(('BKDRVINF',), {2, 89, 99})], False),
+  ],
+  'dui_lam': [
+    ([(('dui',), {True}), (('BOOKED',), {1, 3})], True),
+    ([(('BOOKED',), {2})], False),
+  ],
+  'dui_lam_12': [
+    ([(('dui',), {True}), (('NOBOOKY2',), _BOOKED_12)], True),
+    ([(('NOBOOKY2',), {0, 999})], False),
+  ],
+}
+
+DRUGS_RULES = {
+  'drugs_arrest': [
+    ([(('BKDRUG',), {1, 3})], True),
+    ([(('BKDRUG',), {2, 4, 99})], False),
+  ],
+  'drugs_sold': [
+    ([(_SELL_GRP0, {2, 3, 4, 5})], True),
+    ([(_SELL_GRP1, {1, 3})], True),
+    ([(_SELL_GRP0, {1})], False),
+    ([(_SELL_GRP1, {2})], False),
+  ],
+  'drugs_sold_lam': [
+    ([(('drugs_sold',), {True}), (('BOOKED',), {1, 3})], True),
+    ([(('BOOKED',), {2})], False),
+  ],
+  'drugs_sold_lam_12': [
+    ([(('drugs_sold',), {True}), (('NOBOOKY2',), _BOOKED_12)], True),
+    ([(('NOBOOKY2',), {0, 999})], False),
+  ],
+  'drugs_use': [
+    ([(_USE_GRP0, {1})], True),
+    ([(_USE_GRP1, {1, 7})], True),
+    ([(_USE_GRP0 + _USE_GRP1, {0})], False),
+    ([(_USE_GRP1, {2, 3, 12, 91})], False),
+  ],
+  'drugs_use_lam': [
+    ([(('drugs_use',), {True}), (('BOOKED',), {1, 3})], True),
+    ([(('BOOKED',), {2})], False),
+  ],
+  'drugs_use_lam_12': [
+    ([(('drugs_use',), {True}), (('NOBOOKY2',), _BOOKED_12)], True),
+    ([(('NOBOOKY2',), {0, 999})], False),
+  ],
+}
+
+
+# Compact dtypes of the respondent-level frame, applied after each stage of
+# `derive_outcomes`. Recoded survey variables not listed here are stored in
+# the smallest nullable integer type that holds their codes (mostly `Int8`).
+DTYPE_PLAN = {
+  'YEAR': pd.UInt16Dtype(),
+  'IRSEX': 'category',
+  'offender_sex': 'category',
+  'offender_race': pd.CategoricalDtype(['White', 'Black', 'Hispanic']),
+  'offender_age': pd.CategoricalDtype(['< 18', '18-34', '> 34']),
+  **{outcome: pd.BooleanDtype() for outcome in [*DUI_RULES, *DRUGS_RULES]},
+}
+
+
+def _apply_dtype_plan(df):
+  for name in df.columns:
+    if name in DTYPE_PLAN:
+      if df[name].dtype != DTYPE_PLAN[name]:
+        df[name] = df[name].astype(DTYPE_PLAN[name])
+    elif name in variable_pp and df[name].dtype.kind in 'iu':
+      df[name] = pd.to_numeric(df[name], downcast='integer')
+  return df
+
+
+def _apply_rules(df, rules):
+  """Evaluates the clauses of each outcome as boolean masks over columns."""
+  def _holds(conditions):
+    return np.logical_and.reduce([
+      np.logical_or.reduce([_is_in(df, col, values) for col in columns])
+      for columns, values in conditions
+    ])
+
+  for outcome, clauses in rules.items():
+    derived = np.select(
+      [_holds(conditions) for conditions, _ in clauses],
+      [result for _, result in clauses],
+      default=None,
+    )
+    df[outcome] = pd.Series(
+      pd.array(derived, dtype=pd.BooleanDtype()), index=df.index)
+  return df
+
+
 def add_dui(df):
-  def _dui(df):
-    grp0 = {'DRVINALCO2', 'DRVINMARJ2', 'DRVINDRG', 'DRVINDROTMJ', 'DRVINALDRG'}
-    grp1 = {'DRVALDR', 'DRVAONLY', 'DRVDONLY'}
-    grp2 = {'DRUNKDRV', 'DRDRVUN', 'DRIVEAL', 'DRIVEDR'}
-    union = grp0.union(grp1, grp2)
-
-    def _process(row):
-      if any(_nan_value(row[col]) == 1 for col in grp0.union(grp1)):
-        return True
-      if any(_nan_value(row[col]) in {1, 3} for col in grp2):
-        return True
-      if any(_nan_value(row[col]) == 0 for col in grp0):
-        return False
-      if any(_nan_value(row[col]) in {2, 81, 91, 99} for col in grp1):
-        return False
-      if any(_nan_value(row[col]) == 2 for col in grp2):
-        return False
-      return None
-
-    df['dui'] = df.apply(_process, axis=1)
-    df = df.drop(columns=list(union), errors='ignore')
-    return df
-
-  def _dui_arrest(df):
-    def _process(row):
-      if _nan_value(row['BKDRVINF']) in {1, 3}:
-        return True
-      if _nan_value(row['BKOTHOFF']) == 10:
-        return True
-      if _nan_value(row['BKDRVINF']) in {2, 89, 99}:
-        return False
-      return None
-
-    df['dui_arrests'] = df.apply(_process, axis=1)
-    df = df.drop(columns=['BKDRVINF', 'BKOTHOFF'], errors='ignore')
-    return df
-
-  #df = _dui(df)
-  #df = _dui_arrest(df)
-  #return df
-
-  def _dui_any_arrest(df):
-    def _process(row):
-      if _nan_value(row['dui']) is True and _nan_value(row['BOOKED']) in {1, 3}:
-        return True
-      if _nan_value(row['BOOKED']) in {2}:
-        return False
-      return None
-
-    df['dui_lam'] = df.apply(_process, axis=1)
-    #df = df.drop(columns={'BOOKED'}, errors='ignore')
-    return df
-
-  def _dui_any_arrest_12(df):
-    def _process(row):
-      if _nan_value(row['dui']) is True and _nan_value(row['NOBOOKY2']) in {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20}:
-        return True
-      if _nan_value(row['NOBOOKY2']) in {0, 999}:
-        return False
-      return None
-
-    df['dui_lam_12'] = df.apply(_process, axis=1)
-    #df = df.drop(columns={'BOOKED'}, errors='ignore')
-    return df
-
-  df = _dui(df)
-  df = _dui_arrest(df)
-  df = _dui_any_arrest(df)
-  df = _dui_any_arrest_12(df)
+  df = _apply_rules(df, DUI_RULES)
+  df = df.drop(
+    columns=list(_DUI_GRP0 + _DUI_GRP1 + _DUI_GRP2) + ['BKDRVINF', 'BKOTHOFF'],
+    errors='ignore')
   return df
 
 
 def add_drugs(df):
-  def _drugs_arrest(df):
-    def _process(row):
-      if _nan_value(row['BKDRUG']) in {1, 3}:
-        return True
-      if _nan_value(row['BKDRUG']) in {2, 4, 99}:
-        return False
-      return None
-
-    df['drugs_arrest'] = df.apply(_process, axis=1)
-    df = df.drop(columns='BKDRUG', errors='ignore')
-    return df
-
-
-  def _drugs_sold(df):
-    grp0 = {'YEYSELL', 'SNYSELL'}
-    grp1 = {'SOLDDRUG'}
-    union = grp0.union(grp1)
-
-    def _process(row):
-      if any(_nan_value(row[col]) in {2, 3, 4, 5} for col in grp0):
-        return True
-      if any(_nan_value(row[col]) in {1, 3} for col in grp1):
-        return True
-      if any(_nan_value(row[col]) == 1 for col in grp0):
-        return False
-      if any(_nan_value(row[col]) == 2 for col in grp1):
-        return False
-      return None
-
-    df['drugs_sold'] = df.apply(_process, axis=1)
-    df = df.drop(columns=list(union), errors='ignore')
-    return df
-
-  def _drugs_sold_any_arrest(df):
-    def _process(row):
-      if _nan_value(row['drugs_sold']) is True and _nan_value(row['BOOKED']) in {1, 3}:
-        return True
-      if _nan_value(row['BOOKED']) in {2}:
-        return False
-      return None
-
-    df['drugs_sold_lam'] = df.apply(_process, axis=1)
-    return df
-
-  def _drugs_sold_any_arrest_12(df):
-    def _process(row):
-      if _nan_value(row['drugs_sold']) is True and _nan_value(row['NOBOOKY2']) in {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20}:
-        return True
-      if _nan_value(row['NOBOOKY2']) in {0, 999}:
-        return False
-      return None
-
-    df['drugs_sold_lam_12'] = df.apply(_process, axis=1)
-    return df
-
-
-  def _drugs_use(df):
-    grp0 = {'MRJMON', 'COCMON', 'CRKMON', 'HERMON', 'HALLUCMON', 'LSDMON',
-           'PCPMON', 'ECSTMOMON', 'DAMTFXMON', 'KETMINMON', 'SALVIAMON',
-           'INHALMON', 'METHAMMON'}
-    grp1 = {'HALLREC'}
-    union = grp0.union(grp1)
-
-    def _process(row):
-      if any(_nan_value(row[col]) == 1 for col in grp0):
-        return True
-      if any(_nan_value(row[col]) in {1, 7} for col in grp1):
-        return True
-      if any(_nan_value(row[col]) == 0 for col in grp0.union(grp1)):
-        return False
-      if any(_nan_value(row[col]) in {2, 3, 12, 91} for col in grp1):
-        return False
-      return None
-    df['drugs_use'] = df.apply(_process, axis=1)
-    df = df.drop(columns=list(union), errors='ignore')
-    return df
-
-  def _drugs_use_any_arrest(df):
-    def _process(row):
-      if _nan_value(row['drugs_use']) and _nan_value(row['BOOKED']) in {1, 3}:
-        return True
-      if _nan_value(row['BOOKED']) in {2}:
-        return False
-      return None
-
-    df['drugs_use_lam'] = df.apply(_process, axis=1)
-    df = df.drop(columns={'BOOKED'}, errors='ignore')
-    return df
-
-  def _drugs_use_any_arrest_12(df):
-    def _process(row):
-      if _nan_value(row['drugs_use']) and _nan_value(row['NOBOOKY2']) in list(range(1, 21)):
-        return True
-      if _nan_value(row['NOBOOKY2']) in {0, 999}:
-        return False
-      return None
-
-    df['drugs_use_lam_12'] = df.apply(_process, axis=1)
-    df = df.drop(columns={'NOBOOKY2'}, errors='ignore')
-    return df
-
-  df = _drugs_arrest(df)
-  df = _drugs_sold(df)
-  df = _drugs_sold_any_arrest(df)
-  df = _drugs_sold_any_arrest_12(df)
-  df = _drugs_use(df)
-  df = _drugs_use_any_arrest(df)
-  df = _drugs_use_any_arrest_12(df)
+  df = _apply_rules(df, DRUGS_RULES)
+  df = df.drop(
+    columns=list(_SELL_GRP0 + _SELL_GRP1 + _USE_GRP0 + _USE_GRP1)
+    + ['BKDRUG', 'BOOKED', 'NOBOOKY2'],
+    errors='ignore')
   return df
 
 
-def preprocess(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+def derive_outcomes(df: pd.DataFrame) -> pd.DataFrame:
+  """Recodes the survey variables and derives the per-respondent outcomes."""
   logger.info(f"Preprocessing data")
   for variable in tqdm.tqdm(get_variables()):
     if variable in df.columns:
       df = variable_pp[variable](df, name=variable)
-    else:
-      df[variable] = None  # set all values as missing
+    else:  # set all values as missing
+      df[variable] = pd.Series(pd.NA, index=df.index, dtype=pd.Int8Dtype())
+  df = _apply_dtype_plan(df)
+  memory_report(df, stage='recoding')
   logger.info(f"Preprocessing age")
-  df = add_age(df)
+  df = _apply_dtype_plan(add_age(df))
+  memory_report(df, stage='age')
   logger.info(f"Preprocessing race")
-  df = add_race(df)
+  df = _apply_dtype_plan(add_race(df))
+  memory_report(df, stage='race')
   logger.info(f"Preprocessing DUI")
-  df = add_dui(df)
+  df = _apply_dtype_plan(add_dui(df))
+  memory_report(df, stage='DUI')
   logger.info(f"Preprocessing drugs")
-  df = add_drugs(df)
+  df = _apply_dtype_plan(add_drugs(df))
+  memory_report(df, stage='drugs')
   df = df.rename(columns={"EDUHIGHCAT": "education", "IRSEX": "offender_sex"})
+  return df
+
+
+def preprocess(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+  df = derive_outcomes(df)
   logger.info('Compute arrest rates')
   dfs = compute_arrest_rates(df)
 
   return dfs
 
 
-def compute_arrest_rates(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
-  groups = ['offender_race', 'offender_age', 'offender_sex', 'YEAR']
-  grouped = df.groupby(groups)
-  counts = grouped.size().to_frame('count').reset_index()
+def preprocess_streaming(frames: Iterable[pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+  """Same as `preprocess` on the concatenation of `frames` (e.g., survey years).
+
+  Each frame is reduced to per-group sufficient statistics before the next
+  one is consumed, so only one frame of respondents is in memory at a time.
+  """
+  stats = []
+  for df in frames:
+    df = derive_outcomes(df)
+    stats.append(_sufficient_statistics(df, groups=GROUPS))
+    del df
+  stats = pd.concat(stats, ignore_index=True)
+  stats = stats.groupby(GROUPS, sort=False).sum().reset_index()  # if any overlap
+  logger.info('Compute arrest rates')
+  dfs = _arrest_rates_from_statistics(stats)
+
+  return dfs
+
+
+ARREST_RATES = [
+  'dui', 'dui_lam', 'dui_lam_12',
+  'drugs_use', 'drugs_use_lam', 'drugs_use_lam_12',
+  'drugs_sell', 'drugs_sell_lam', 'drugs_sell_lam_12',
+  'drugs_any',
+]
+
+
+GROUPS = ['offender_race', 'offender_age', 'offender_sex', 'YEAR']
+
+
+def compute_arrest_rates(
+    df: pd.DataFrame, n_boot: int = None) -> Dict[str, pd.DataFrame]:
+  """With `n_boot`, adds bootstrap bands `*_sar_lo`/`*_sar_hi` to `*_sar`."""
+  stats = _sufficient_statistics(df, groups=GROUPS)
+  return _arrest_rates_from_statistics(stats, n_boot=n_boot)
+
+
+def _arrest_rates_from_statistics(
+    stats: pd.DataFrame, n_boot: int = None) -> Dict[str, pd.DataFrame]:
+  groups = GROUPS
+  rates = _raw_arrest_rates(stats)
+  counts = rates[groups + ['count']]
 
   # ensure we predict data for all years and groups
-  all_combinations = itertools.product(*[df[c].unique() for c in groups])
-  all_combinations = pd.DataFrame(all_combinations, columns=groups)
-  agg = pd.merge(all_combinations, counts, how='left', on=groups)
+  agg = expand_grid(counts, groups)
 
-  # compute arrest rates and smooth them
-  _smooth_arrests = functools.partial(
-    _smooth_arrest_rates, counts=counts, grouped=grouped, groups=groups)
-  smoothed = {mode: _smooth_arrests(agg, mode=mode) for mode in SMOOTHING}
+  # smooth the (shared) raw arrest rates, all modes at once
+  smoothed = _smooth_arrest_rates(
+    agg, rates=rates, groups=groups, n_boot=n_boot)
 
   return smoothed
 
 
-def _arrest_rate_fns():
+def _arrest_rate_terms(df: pd.DataFrame) -> Dict[str, tuple]:
+  """Per-respondent (numerator, denominator) of each arrest rate.
+
+  Missing outcomes are NaN, so they drop out of the grouped sums.
+  """
+  def _col(name):
+    return df[name].astype(float)
+
+  dui, drugs_use, drugs_sold = _col('dui'), _col('drugs_use'), _col('drugs_sold')
+  drugs_use_only = drugs_use * (1 - drugs_sold)
   spec = {
-    'dui': lambda g: _sdiv(g['dui_arrests'].sum(), g['dui'].sum()),
-    'dui_lam': lambda g: _sdiv(g['dui_lam'].sum(), g['dui'].sum()),
-    'dui_lam_12': lambda g: _sdiv(g['dui_lam_12'].sum(), g['dui'].sum()),
-
-    'drugs_use': lambda g: _sdiv(
-      (g['drugs_arrest'] * g['drugs_use'] * (1 - g['drugs_sold'])).sum(),
-      (g['drugs_use'] * (1 - g['drugs_sold'])).sum()
-    ),
-    'drugs_use_lam': lambda g: _sdiv(
-      (g['drugs_use_lam'] * (1 - g['drugs_sold'])).sum(),
-      (g['drugs_use'] * (1 - g['drugs_sold'])).sum()
-    ),
-    'drugs_use_lam_12': lambda g: _sdiv(
-      (g['drugs_use_lam_12'] * (1 - g['drugs_sold'])).sum(),
-      (g['drugs_use'] * (1 - g['drugs_sold'])).sum()
-    ),
-    'drugs_sell': lambda g: _sdiv(
-      (g['drugs_arrest'] * g['drugs_sold']).sum(),
-      g['drugs_sold'].sum()
-    ),
-    'drugs_sell_lam': lambda g: _sdiv(
-      g['drugs_sold_lam'].sum(),
-      g['drugs_sold'].sum()
-    ),
-    'drugs_sell_lam_12': lambda g: _sdiv(
-      g['drugs_sold_lam_12'].sum(),
-      g['drugs_sold'].sum()
-    ),
-
-    'drugs_any': lambda g: _sdiv(
-      g['drugs_arrest'].sum(),
-      ((g['drugs_use'] + g['drugs_sold']) > 0).sum()
-    ),
+    'dui': (_col('dui_arrests'), dui),
+    'dui_lam': (_col('dui_lam'), dui),
+    'dui_lam_12': (_col('dui_lam_12'), dui),
+
+    'drugs_use': (_col('drugs_arrest') * drugs_use_only, drugs_use_only),
+    'drugs_use_lam': (
+      _col('drugs_use_lam') * (1 - drugs_sold), drugs_use_only),
+    'drugs_use_lam_12': (
+      _col('drugs_use_lam_12') * (1 - drugs_sold), drugs_use_only),
+    'drugs_sell': (_col('drugs_arrest') * drugs_sold, drugs_sold),
+    'drugs_sell_lam': (_col('drugs_sold_lam'), drugs_sold),
+    'drugs_sell_lam_12': (_col('drugs_sold_lam_12'), drugs_sold),
+
+    'drugs_any': (
+      _col('drugs_arrest'), ((drugs_use + drugs_sold) > 0).astype(float)),
   }
   return spec
 
 
-def _smooth_arrest_rates(agg, mode, counts, grouped, groups):
-  agg = agg.copy()
+def _sufficient_statistics(df: pd.DataFrame, groups: List[str]) -> pd.DataFrame:
+  """Group sizes and summed arrest rate terms, from a single grouped sum.
 
-  spec = _arrest_rate_fns()
+  Groups are kept in order of first appearance.
+  """
+  terms = {}
+  for crime, (numerator, denominator) in _arrest_rate_terms(df).items():
+    terms[f'{crime}_num'] = numerator
+    terms[f'{crime}_den'] = denominator
+  terms = pd.DataFrame(terms, index=df.index)
+  terms['count'] = 1
+
+  keys = [df[g] for g in groups]
+  stats = terms.groupby(keys, sort=False, observed=True).sum().reset_index()
+  for g in groups:  # plain dtypes in the (small) group table
+    if stats[g].dtype.name == 'category':
+      stats[g] = stats[g].astype(object)
+    elif stats[g].dtype.kind in 'iu':
+      stats[g] = stats[g].astype(np.int64)
+  return stats
+
+
+def _raw_arrest_rates(stats: pd.DataFrame) -> pd.DataFrame:
+  rates = stats[[c for c in stats.columns if not c.endswith(('_num', '_den'))]]
+  rates = rates.copy()
+  for crime in ARREST_RATES:
+    numerator, denominator = stats[f'{crime}_num'], stats[f'{crime}_den']
+    rates[f'{crime}_ar'] = (numerator / denominator).where(denominator != 0, 0)
+  return rates
+
+
+def _smooth_arrest_rates(
+    agg, rates, groups, n_boot=None) -> Dict[str, pd.DataFrame]:
   x_col, count_col = 'YEAR', 'count'
   x_test = agg[x_col].unique()[:, None]  # same for all groups
-  for crime in spec:
+  smoothed, columns = [], list(agg.columns)
+  for crime in ARREST_RATES:
     arrest_col, smooth_col = f'{crime}_ar', f'{crime}_sar'
-    avail_data = grouped.apply(spec[crime]).to_frame(arrest_col).reset_index()
-    avail_data = pd.merge(
-      avail_data,
-      counts,
-      how='left',
-      on=groups
-    )
-    smoothed = smooth_arrest_rates(
-      df=avail_data,
+    smoothed_crime = smooth_arrest_rates_all(
+      df=rates[groups + [arrest_col, count_col]],
       groups=groups,
       x_test=x_test,
       x_col=x_col,
       count_col=count_col,
       arrest_col=arrest_col,
       smooth_col=smooth_col,
-      mode=mode,
+      modes=SMOOTHING,
+      n_boot=n_boot,
     )
-    agg = pd.merge(agg, smoothed, how='left', on=groups)
-    agg = pd.merge(agg, avail_data[groups + [arrest_col]], how='left', on=groups)
-  return agg
+    smoothed.append(smoothed_crime.set_index(['smoothing'] + groups))
+    columns += [smooth_col]
+    if n_boot:
+      columns += [f'{smooth_col}_lo', f'{smooth_col}_hi']
+    columns += [arrest_col]
+  smoothed = pd.concat(smoothed, axis=1).reset_index()
+
+  arrest_cols = [f'{crime}_ar' for crime in ARREST_RATES]
+  agg = pd.merge(agg, rates[groups + arrest_cols], how='left', on=groups)
+  return {
+    mode: pd.merge(
+      agg, smoothed[smoothed['smoothing'] == mode].drop(columns='smoothing'),
+      how='left', on=groups)[columns]
+    for mode in SMOOTHING
+  }
@@ -1,12 +1,16 @@
 from pathlib import Path
-from cj_pipeline.nsduh.load import load_nsduh
-from cj_pipeline.nsduh.preprocess import preprocess
+from cj_pipeline.nsduh.load import iter_nsduh, load_nsduh
+from cj_pipeline.nsduh.preprocess import preprocess, preprocess_streaming
 
 
-def main():
+def main(n_workers: int = None, streaming: bool = False, **sample):
+  """`sample` (e.g., `sample_n=1000`) makes a dry run on a random subset."""
   save_path = Path(__file__).parents[2] / 'data' / 'processed'
-  nsduh = load_nsduh()
-  nsduh_dicts = preprocess(nsduh)
+  if streaming:  # one survey year in memory at a time
+    nsduh_dicts = preprocess_streaming(iter_nsduh(**sample))
+  else:
+    nsduh = load_nsduh(n_workers=n_workers, **sample)  # None -> one worker per core
+    nsduh_dicts = preprocess(nsduh)
   for mode in nsduh_dicts:
     nsduh_dicts[mode].to_csv(save_path / f'nsduh_{mode}.csv', index=False)
 
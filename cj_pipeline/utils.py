@@ -1,9 +1,14 @@
+import os
+import hashlib
+import warnings
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 
-from typing import List
-from cj_pipeline.config import logger
-from sklearn.linear_model import LinearRegression
+from pathlib import Path
+from typing import Callable, List
+from pandas.api.types import union_categoricals
+from cj_pipeline.config import logger, CACHE_DIR, POOLED_GROUPS
 
 
 def subset_pd_bool(df, **kwargs):
@@ -17,6 +22,132 @@ def subset_pd(df, **kwargs):
   return df[subset_pd_bool(df, **kwargs)]
 
 
+def map_distinct(col: pd.Series, mapper: Callable, dtype=object) -> pd.Series:
+  """Maps `col` by evaluating `mapper` once per distinct value.
+
+  The results are broadcast back through the integer codes of `col` (its
+  categorical codes, or those of `pd.factorize`); missing values stay missing.
+  """
+  if col.dtype.name == 'category':
+    codes, uniques = col.cat.codes.to_numpy(), col.cat.categories
+  else:
+    codes, uniques = pd.factorize(col)
+  lookup = pd.array([mapper(value) for value in uniques], dtype=dtype)
+  return pd.Series(
+    lookup.take(codes, allow_fill=True), index=col.index, name=col.name)
+
+
+def concat_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+  """Concatenates chunks without losing their categorical dtypes.
+
+  Chunks of a partially labelled variable may carry different categories;
+  these are unified first (`pd.concat` would fall back to object).
+  """
+  if len(chunks) > 1:
+    dtypes = {}
+    for col in chunks[0].columns:
+      if chunks[0][col].dtype.name != 'category':
+        continue
+      dtypes[col] = pd.CategoricalDtype(union_categoricals(
+        [chunk[col] for chunk in chunks], ignore_order=True).categories)
+    chunks = [chunk.astype(dtypes) for chunk in chunks]
+  return pd.concat(chunks)
+
+
+def memory_report(df: pd.DataFrame, stage: str) -> pd.Series:
+  """Logs the memory footprint of `df`, per column (in bytes)."""
+  usage = df.memory_usage(index=False, deep=True)
+  columns = ', '.join(f'{col}={n}' for col, n in usage.items())
+  logger.info(f'Memory after {stage}: {usage.sum() / 2**20:.1f} MiB '
+              f'({len(df)} rows; {columns})')
+  return usage
+
+
+def read_cached(
+    read_fn: Callable[[], pd.DataFrame],
+    source: Path,
+    key: tuple = (),
+) -> pd.DataFrame:
+  """Returns `read_fn()`, memoized as a Parquet file in `CACHE_DIR`.
+
+  The cache entry is keyed by the size and modification time of `source`
+  and by `key`, so editing the source (or changing `key`) invalidates it.
+  """
+  stat = source.stat()
+  fingerprint = repr((source.name, stat.st_size, stat.st_mtime_ns, key))
+  digest = hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+  cache_path = CACHE_DIR / f'{source.stem}-{digest}.parquet'
+  if cache_path.is_file():
+    logger.debug(f'Reading cached {source.name} from {cache_path}')
+    return _read_parquet(cache_path)
+
+  df = storable_categories(read_fn())
+  CACHE_DIR.mkdir(parents=True, exist_ok=True)
+  tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')  # parallel writers
+  df.to_parquet(tmp_path)
+  tmp_path.replace(cache_path)
+  return df
+
+
+def _read_parquet(path: Path) -> pd.DataFrame:
+  """`pd.read_parquet`, keeping categorical columns without categories.
+
+  Parquet stores such a column (e.g. a label that is missing throughout) as
+  nulls, which would read back as `object`; the pandas metadata of the file
+  still records it as categorical.
+  """
+  df = pd.read_parquet(path)
+  for column in pq.read_schema(path).pandas_metadata['columns']:
+    name = column['name']
+    if (column['pandas_type'] == 'categorical' and name in df.columns
+        and df[name].dtype.name != 'category'):
+      df[name] = df[name].astype(
+        pd.CategoricalDtype([], ordered=column['metadata']['ordered']))
+  return df
+
+
+def storable_categories(df: pd.DataFrame) -> pd.DataFrame:
+  """Casts categories of mixed types to str, which Parquet can store.
+
+  Stata variables whose value labels cover only some codes (e.g. 1/2 labelled,
+  81/91/99 not) read as categories mixing labels and numbers. `read_cached`
+  applies the cast before writing; readers that can bypass the cache apply it
+  too, so the cache setting does not change the frame.
+  """
+  for col in df.columns:
+    if df[col].dtype.name != 'category':
+      continue
+    categories = df[col].cat.categories
+    if pd.api.types.infer_dtype(categories).startswith('mixed'):
+      df[col] = df[col].cat.rename_categories(categories.astype(str))
+  return df
+
+
+def expand_grid(
+    df: pd.DataFrame,
+    groups: List[str],
+    levels: List = None,
+    sparse: bool = False,
+) -> pd.DataFrame:
+  """Reindexes the rows of `df` onto every combination of `groups`.
+
+  `levels` are the values of each group (default: the distinct values in
+  `df`, in order of appearance); the grid is their product, in the order of
+  `itertools.product`. `df` has at most one row per combination; missing
+  combinations get NaN values, kept as sparse columns with `sparse=True`.
+  """
+  if levels is None:
+    levels = [df[g].unique() for g in groups]
+  grid = pd.MultiIndex.from_product(levels, names=groups)
+  expanded = df.set_index(groups).reindex(grid)
+  if sparse:
+    expanded = expanded.astype({
+      c: pd.SparseDtype(np.result_type(expanded[c].dtype, float), np.nan)
+      for c in expanded.columns
+    })
+  return expanded.reset_index()
+
+
 def smooth_arrest_rates(
     df: pd.DataFrame,
     groups: List[str],
@@ -26,66 +157,429 @@ def smooth_arrest_rates(
     arrest_col: str,
     smooth_col: str,
     mode: str,
+    n_boot: int = None,
+    seed: int = 0,
 ) -> pd.DataFrame:
+  """Smooths `arrest_col` over `x_col` within each of the other `groups`.
+
+  The result has one row per group and `x_test` value; see
+  `smooth_arrest_rates_all` for several modes at once and for `n_boot`.
+  """
+  smoothed = smooth_arrest_rates_all(
+    df=df,
+    groups=groups,
+    x_test=x_test,
+    x_col=x_col,
+    count_col=count_col,
+    arrest_col=arrest_col,
+    smooth_col=smooth_col,
+    modes=[mode],
+    n_boot=n_boot,
+    seed=seed,
+  )
+  return smoothed.drop(columns='smoothing')
+
+
+def smooth_arrest_rates_all(
+    df: pd.DataFrame,
+    groups: List[str],
+    x_test: np.ndarray,
+    x_col: str,
+    count_col: str,
+    arrest_col: str,
+    smooth_col: str,
+    modes: List[str],
+    n_boot: int = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+  """Smoothed arrest rates for each of `modes`, as one long table.
+
+  The data is grouped once. All groups are fitted at once from their
+  weighted moments (see `weighted_moments`), which are computed once per
+  filter and shared by the smoothers. The result has one row per mode (in
+  the `smoothing` column), group and `x_test` value.
+
+  With `n_boot`, the 95% percentile band of `n_boot` bootstrap replicates
+  (see `bootstrap_moments`) is added as `{smooth_col}_lo`/`_hi`.
+  """
+  codes, keys = _group_codes(df, groups, x_col)
+  parents = _parent_codes(keys)
+  fits = _fit_modes(df, modes, codes, len(keys), x_col, count_col, arrest_col)
+  available = (codes >= 0) & df[arrest_col].notna().to_numpy()
+
+  smoothed, boot_moments = [], {}
+  for mode, (mask, smoother, moments) in fits.items():
+    values = smoother(moments, x_test=x_test, parents=parents)
+
+    # groups without data, unless the smoother fills them in (see `eb_`)
+    empty = (moments['n'] == 0).to_numpy() & np.isnan(values).all(axis=1)
+    for _, group in keys[empty].iterrows():
+      logger.warn(f'no arrest data to smooth for "{arrest_col}" in group: '
+                  f'{group.to_dict()}')
+    values[empty] = np.nan
+    if np.isnan(values[~empty]).any():
+      raise RuntimeError('NaN values in smoothed regression')
+
+    smoothed_mode = keys.loc[keys.index.repeat(len(x_test))]
+    smoothed_mode[smooth_col] = values.ravel()
+    if n_boot:
+      weighting = mode.split('_', 1)[1]
+      if weighting not in boot_moments:  # same replicates for every smoother
+        fitted = mask & available
+        boot_moments[weighting] = bootstrap_moments(
+          codes=codes[fitted],
+          x=df[x_col].to_numpy(dtype=float)[fitted],
+          y=df[arrest_col].to_numpy(dtype=float)[fitted],
+          weights=df[count_col].to_numpy(dtype=float)[fitted],
+          n_groups=len(keys),
+          n_boot=n_boot,
+          rng=np.random.default_rng(seed),
+        )
+      boot_parents = (parents[:, None] * n_boot + np.arange(n_boot)).ravel()
+      boot = smoother(
+        boot_moments[weighting], x_test=x_test, parents=boot_parents)
+      boot = boot.reshape(len(keys), n_boot, len(x_test))
+      with warnings.catch_warnings():  # all-NaN for groups without data
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lo, hi = np.nanpercentile(boot, [2.5, 97.5], axis=1)
+      lo[empty], hi[empty] = np.nan, np.nan
+      smoothed_mode[f'{smooth_col}_lo'] = lo.ravel()
+      smoothed_mode[f'{smooth_col}_hi'] = hi.ravel()
+    smoothed_mode[x_col] = np.tile(x_test.squeeze(1), len(keys))
+    smoothed_mode['smoothing'] = mode
+    smoothed.append(smoothed_mode)
+
+  smoothed = pd.concat(smoothed, ignore_index=True)
+  smoothed[x_col] = smoothed[x_col].astype(df[x_col].dtype)
+  return smoothed
+
+
+def bootstrap_moments(
+    codes: np.ndarray,
+    x: np.ndarray,
+    y: np.ndarray,
+    weights: np.ndarray,
+    n_groups: int,
+    n_boot: int,
+    rng: np.random.Generator,
+) -> pd.DataFrame:
+  """`weighted_moments` of `n_boot` bootstrap replicates of every group.
+
+  Each replicate multiplies the weight of every point by an independent
+  Poisson(1) draw; the group sums of all replicates are a single product
+  with the one-hot group matrix. Row `g * n_boot + b` is replicate `b` of
+  group `g`.
+  """
+  one_hot = np.zeros((n_groups, len(codes)))
+  one_hot[codes, np.arange(len(codes))] = 1.0
+  draws = rng.poisson(1.0, size=(len(codes), n_boot))
+  w = weights[:, None] * draws
+
+  sum_w = one_hot @ w
+  with np.errstate(divide='ignore', invalid='ignore'):
+    mx = one_hot @ (w * x[:, None]) / sum_w
+    my = one_hot @ (w * y[:, None]) / sum_w
+  # replicates without weight have no mean, and no weight on the rows below
+  dx = x[:, None] - np.nan_to_num(mx)[codes]
+  dy = y[:, None] - np.nan_to_num(my)[codes]
+  return pd.DataFrame({
+    'n': (one_hot @ (draws > 0)).ravel().astype(int),
+    'w': sum_w.ravel(),
+    'mx': mx.ravel(),
+    'my': my.ravel(),
+    'sxx': (one_hot @ (w * dx * dx)).ravel(),
+    'sxy': (one_hot @ (w * dx * dy)).ravel(),
+  })
+
+
+def validate_smoothing(
+    df: pd.DataFrame,
+    groups: List[str],
+    x_col: str,
+    count_col: str,
+    arrest_col: str,
+    modes: List[str],
+) -> pd.DataFrame:
+  """Leave-one-year-out prediction error of each of `modes`, per group.
+
+  Every available year of a group is predicted by the fit to the group's
+  other years. Held-out fits come in closed form from the full fit and the
+  leverage `h` of the held-out point: the residual is inflated by 1 / (1 - h).
+  Years excluded by a mode's filter are not part of its fit and are
+  predicted by the full fit. Groups with a single year cannot be validated.
+  `loyo_rmse` is weighted by `count_col`.
+  """
+  codes, keys = _group_codes(df, groups, x_col)
+  parents = _parent_codes(keys)
+  fits = _fit_modes(df, modes, codes, len(keys), x_col, count_col, arrest_col)
+  available = (codes >= 0) & df[arrest_col].notna().to_numpy()
+
+  x_test, x_idx = np.unique(df[x_col].to_numpy(dtype=float), return_inverse=True)
+  x, y = df[x_col].to_numpy(dtype=float), df[arrest_col].to_numpy(dtype=float)
+  weights = df[count_col].to_numpy(dtype=float)
+  errors = []
+  for mode, (mask, smoother, moments) in fits.items():
+    fitted = smoother(
+      moments, x_test=x_test[:, None], parents=parents, eps=-np.inf)
+    fitted = fitted[codes, x_idx]  # at each row (unclipped)
+    leverage = _leverage(mode, moments, parents, codes, x, weights)
+    sw, my = moments['w'].to_numpy()[codes], moments['my'].to_numpy()[codes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      held_out = y - (y - fitted) / (1 - leverage)
+      # h = 1: the other years share one x, so their fit is their mean
+      others = (sw * my - weights * y) / (sw - weights)
+    others[sw <= weights] = np.nan
+    held_out = np.where(leverage >= 1 - 1e-9, others, held_out)
+    held_out = np.where(mask & available, held_out, fitted)
+    if not mode.startswith('avg_'):
+      held_out = held_out.clip(min=0.0)  # as in `linear_smoother`
+
+    evaluated = available & ~np.isnan(held_out)
+    w, e2 = weights[evaluated], (y - held_out)[evaluated]**2
+    sum_w = np.bincount(codes[evaluated], weights=w, minlength=len(keys))
+    sum_e2 = np.bincount(codes[evaluated], weights=w * e2, minlength=len(keys))
+    errors_mode = keys.copy()
+    errors_mode['smoothing'] = mode
+    errors_mode['n_years'] = np.bincount(codes[evaluated], minlength=len(keys))
+    errors_mode[count_col] = sum_w
+    with np.errstate(divide='ignore', invalid='ignore'):
+      errors_mode['loyo_rmse'] = np.sqrt(sum_e2 / sum_w)
+    errors.append(errors_mode)
+
+  return pd.concat(errors, ignore_index=True)
+
+
+def _leverage(mode, moments, parents, codes, x, weights):
+  """Diagonal of the hat matrix, for rows of the fitted groups.
+
+  For `eb_` modes the shrinkage weights are taken as fixed, so the leverage
+  mixes those of the group and of the parent trend.
+  """
+  def _linear_leverage(moments, codes):
+    w = moments['w'].to_numpy()[codes]
+    sxx, mx = moments['sxx'].to_numpy()[codes], moments['mx'].to_numpy()[codes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return weights / w + np.where(sxx > 0, weights * (x - mx)**2 / sxx, 0.0)
+
+  if mode.startswith('avg_'):
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return weights / moments['w'].to_numpy()[codes]
+  leverage = _linear_leverage(moments, codes)
+  if mode.startswith('eb_'):
+    shrinkage, parent = _eb_shrinkage(moments, parents)
+    shrinkage = shrinkage[codes]
+    with np.errstate(invalid='ignore'):  # 0 * NaN for groups without data
+      leverage = ((1 - shrinkage) * leverage
+                  + shrinkage * _linear_leverage(parent, codes))
+  return leverage
+
+
+def _group_codes(df, groups, x_col):
+  """Group code of every row (-1 for missing keys) and the group keys."""
   smooth_groups = [g for g in groups if g != x_col]
+  grouped = df.groupby(smooth_groups, observed=True)
+  codes = grouped.ngroup().fillna(-1).to_numpy(int)
+  keys = grouped.size().index.to_frame(index=False)
+  return codes, keys
 
-  def _smooth(group):
-    data = group[group[arrest_col].notna()]
-    data, smoother = init_smoothing(
-      data=data,
+
+def _parent_codes(keys):
+  """Code of the parent of every group: the group pooled over `POOLED_GROUPS`."""
+  parent_cols = [c for c in keys.columns if c not in POOLED_GROUPS]
+  if not parent_cols:
+    return np.zeros(len(keys), dtype=int)
+  return keys.groupby(parent_cols, sort=False).ngroup().to_numpy()
+
+
+def _fit_modes(df, modes, codes, n_groups, x_col, count_col, arrest_col):
+  """`(mask, smoother, moments)` of each mode.
+
+  The weighted moments only depend on a mode's filter (`_pc`, `_pr`,
+  `_all`), so they are computed once per filter and shared by the smoothers.
+  """
+  available = (codes >= 0) & df[arrest_col].notna().to_numpy()
+  moments, fits = {}, {}
+  for mode in modes:
+    mask, smoother = init_smoothing(
+      data=df,
       mode=mode,
       arrest_col=arrest_col,
       count_col=count_col
     )
-    if len(data) == 0:
-      logger.warn(f'no arrest data to smooth for "{arrest_col}" in group: '
-                  f'{group[smooth_groups].drop_duplicates().iloc[0].to_dict()}')
-      return list(zip(x_test.squeeze(1), [None] * len(x_test)))
+    weighting = mode.split('_', 1)[1]
+    if weighting not in moments:
+      fitted = mask & available
+      moments[weighting] = weighted_moments(
+        codes=codes[fitted],
+        x=df[x_col].to_numpy(dtype=float)[fitted],
+        y=df[arrest_col].to_numpy(dtype=float)[fitted],
+        weights=df[count_col].to_numpy(dtype=float)[fitted],
+        n_groups=n_groups,
+      )
+    fits[mode] = mask, smoother, moments[weighting]
+  return fits
 
-    x_train = data[x_col].to_numpy()[:, None]
-    y_train, weights = data[arrest_col], data[count_col]
-    smoothed = smoother(x_train, y_train, weights=weights, x_test=x_test)
-    if pd.isna(smoothed).sum() > 0:
-      raise RuntimeError('NaN values in smoothed regression')
-    return list(zip(x_test.squeeze(1), smoothed))
 
-  smoothed = df.groupby(smooth_groups).apply(
-    _smooth).to_frame(smooth_col).reset_index()
-  smoothed = smoothed.explode(smooth_col)
-  smoothed[x_col] = smoothed[smooth_col].str[0].astype(df[x_col].dtype)
-  smoothed[smooth_col] = smoothed[smooth_col].str[1]
-  return smoothed
+def weighted_moments(
+    codes: np.ndarray,
+    x: np.ndarray,
+    y: np.ndarray,
+    weights: np.ndarray,
+    n_groups: int,
+) -> pd.DataFrame:
+  """Per-group sufficient statistics of a weighted 1-D regression.
+
+  Row `g` holds the number of points `n`, the total weight `w`, the weighted
+  means `mx`, `my` and the centered sums `sxx` = sum w (x - mx)^2 and
+  `sxy` = sum w (x - mx)(y - my) of the points with `codes == g`.
+  """
+  def _sum(values):
+    return np.bincount(codes, weights=values, minlength=n_groups)
+
+  w = _sum(weights)
+
+  def _mean(values):
+    out = np.full(n_groups, np.nan)
+    return np.divide(_sum(weights * values), w, out=out, where=w > 0)
+
+  mx, my = _mean(x), _mean(y)
+  dx, dy = x - mx[codes], y - my[codes]  # centered, for numerical stability
+  return pd.DataFrame({
+    'n': np.bincount(codes, minlength=n_groups),
+    'w': w,
+    'mx': mx,
+    'my': my,
+    'sxx': _sum(weights * dx * dx),
+    'sxy': _sum(weights * dx * dy),
+  })
 
 
 def init_smoothing(data, mode, arrest_col, count_col):
+  """Smoother and (boolean) mask of the rows of `data` it is fitted to."""
   if mode.startswith('lr_'):
     smoother = linear_smoother
   elif mode.startswith('avg_'):
     smoother = avg_smoother
+  elif mode.startswith('eb_'):
+    smoother = eb_smoother
   else:
     raise ValueError(f'Unknown smoother typer "{mode}"')
 
   if mode.endswith('_pc'):
-    data = data[data[count_col] > 0]
+    mask = data[count_col] > 0
   elif mode.endswith('_pr'):
-    data = data[data[arrest_col] > 0]
+    mask = data[arrest_col] > 0
   elif mode.endswith('_all'):
-    pass
+    mask = pd.Series(True, index=data.index)
   else:
     raise ValueError(f'Uknown smoothing mode "{mode}"')
 
-  return data, smoother
+  return mask.to_numpy(), smoother
 
 
-def avg_smoother(x_train, y_train, weights, x_test, **_):
-  weights /= np.nansum(weights)
-  smoothed = [np.nansum(y_train * weights)] * len(x_test)
+def avg_smoother(moments, x_test, **_):
+  """Weighted mean rate of every group, constant over `x_test`.
+
+  A group with data but zero total weight gets 0, as the normalised
+  `nansum` of the former per-group smoother did; groups without data get NaN.
+  """
+  zero_weight = (moments['n'] > 0).to_numpy() & (moments['w'] == 0).to_numpy()
+  mean = np.where(zero_weight, 0.0, moments['my'].to_numpy())
+  smoothed = np.repeat(mean[:, None], len(x_test), axis=1)
   return smoothed
 
 
-def linear_smoother(x_train, y_train, weights, x_test, eps=0.0):
-  model = LinearRegression()
-  model.fit(x_train, y_train, weights)
-  smoothed = model.predict(x_test).clip(min=eps)
-  return smoothed
+def linear_smoother(moments, x_test, eps=0.0, **_):
+  smoothed = _linear_trend(moments, x_test.squeeze(1)[None, :])
+  return smoothed.clip(min=eps)
+
+
+def eb_smoother(moments, x_test, parents=None, eps=0.0, **_):
+  """Linear trends shrunk towards the trend of their parent group.
+
+  `parents` holds the parent code of every group (default: a single
+  parent). Groups without data get the parent trend.
+  """
+  if parents is None:
+    parents = np.zeros(len(moments), dtype=int)
+  shrinkage, parent = _eb_shrinkage(moments, parents)
+  x = x_test.squeeze(1)[None, :]
+  own, pooled = _linear_trend(moments, x), _linear_trend(parent, x)
+  fitted = (moments['w'] > 0).to_numpy()[:, None]
+  smoothed = np.where(
+    fitted, (1 - shrinkage[:, None]) * own + shrinkage[:, None] * pooled, pooled)
+  return smoothed.clip(min=eps)
+
+
+def _linear_trend(moments, x):
+  """Weighted least-squares lines of all groups, evaluated at `x`.
+
+  `x` is broadcast against the groups (rows); a group without spread in x
+  gets a flat line at its mean.
+  """
+  sxx, sxy = moments['sxx'].to_numpy(), moments['sxy'].to_numpy()
+  slope = np.divide(sxy, sxx, out=np.zeros_like(sxy), where=sxx > 0)
+  dx = x - moments['mx'].to_numpy()[:, None]
+  return moments['my'].to_numpy()[:, None] + slope[:, None] * dx
+
+
+def pooled_moments(moments: pd.DataFrame, parents: np.ndarray) -> pd.DataFrame:
+  """Moments of the union of the groups with the same `parents` code.
+
+  The centered sums are combined with the parallel axis theorem, e.g.,
+  sxx = sum (sxx_g + w_g (mx_g - mx)^2).
+  """
+  n_parents = parents.max() + 1 if len(parents) else 0
+  fitted = (moments['w'] > 0).to_numpy()  # others have undefined means
+
+  def _sum(values):
+    return np.bincount(
+      parents[fitted], weights=values[fitted], minlength=n_parents)
+
+  n, w = moments['n'].to_numpy(), moments['w'].to_numpy()
+  mx, my = moments['mx'].to_numpy(), moments['my'].to_numpy()
+  sum_w = _sum(w)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    parent_mx, parent_my = _sum(w * mx) / sum_w, _sum(w * my) / sum_w
+  dx, dy = mx - parent_mx[parents], my - parent_my[parents]
+  return pd.DataFrame({
+    'n': _sum(n).astype(int),
+    'w': sum_w,
+    'mx': parent_mx,
+    'my': parent_my,
+    'sxx': _sum(moments['sxx'].to_numpy() + w * dx * dx),
+    'sxy': _sum(moments['sxy'].to_numpy() + w * dx * dy),
+  })
+
+
+def _eb_shrinkage(moments, parents):
+  """Weight of the parent trend in each group's fit, and the parent moments.
+
+  The weight is sigma^2 / (sigma^2 + tau^2): sigma^2 = p (1 - p) / w is the
+  binomial variance of the group's mean rate (p is the parent's mean rate),
+  tau^2 the spread of the group means around the parent trend, estimated by
+  the method of moments within each parent. The parent moments are aligned
+  with the groups.
+  """
+  parent = pooled_moments(moments, parents).iloc[parents].reset_index(drop=True)
+  w, mx, my = (moments[c].to_numpy() for c in ['w', 'mx', 'my'])
+  fitted = w > 0
+
+  p = parent['my'].to_numpy().clip(0, 1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    sigma2 = p * (1 - p) / w
+  deviation2 = (my - _linear_trend(parent, mx[:, None])[:, 0])**2
+
+  def _mean(values):  # over the fitted groups of each parent
+    n_parents = parents.max() + 1
+    total = np.bincount(
+      parents[fitted], weights=values[fitted], minlength=n_parents)
+    count = np.bincount(parents[fitted], minlength=n_parents)
+    return (total / np.maximum(count, 1))[parents]
 
+  tau2 = np.maximum(_mean(deviation2) - _mean(sigma2), 0)
+  total = sigma2 + tau2
+  shrinkage = np.divide(
+    sigma2, total, out=np.zeros_like(total), where=fitted & (total > 0))
+  shrinkage[~fitted] = 1.0
+  return shrinkage, parent
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from cj_pipeline import utils
+from cj_pipeline.ncvs import load
+from cj_pipeline.ncvs import preprocess as ncvs
+
+
+def _incidents():
+  no, yes = '(2) No', '(1) Yes'
+  columns = [
+    'crime_type', 'c_mult_off_race_black', 'c_mult_off_race_white',
+    'single_offender_race_end_2011_q4',
+    'multiple_offender_race_of_most_end_2011_q4',
+    'multiple_offender_race_of_most_start_2012_q1',
+    'c_single_offender_race_white_start_2012_q1',
+    'c_single_offender_race_black_or_african_american_start_2012_q1',
+    'single_offender_age', 'multiple_offenders_age_of_oldest',
+    'multiple_offenders_age_of_youngest', 'single_offender_sex',
+    'multiple_offenders_sex', 'multiple_offenders_mostly_male_or_female',
+    'reported_to_police', 'arrests_or_charges_made']
+  return pd.DataFrame([
+    # single offender, reported and arrested
+    ('(01) Completed rape', no, no, '(2) Black', np.nan, np.nan, np.nan,
+     np.nan, '(4) 18-20', np.nan, np.nan, '(1) Male', np.nan, np.nan,
+     yes, yes),
+    # multiple offenders, same age bin; not reported, so no arrest
+    ('(57) Theft $250+', no, yes, np.nan, np.nan, np.nan, np.nan, np.nan,
+     np.nan, '(6) 30+', '(6) 30+', np.nan, '(3) Both', '(2) Mostly female',
+     no, np.nan),
+    # multiple offenders in different age bins: dropped
+    ('(11) Ag aslt w injury', yes, no, np.nan, np.nan, np.nan, np.nan,
+     np.nan, np.nan, '(6) 30+', '(4) 18-20', np.nan, '(1) All male', np.nan,
+     yes, no),
+    # 2012+ race questions, out of universe arrests
+    ('(14) Simp aslt w inj', no, no, np.nan, np.nan, np.nan, np.nan, yes,
+     '(3) 15-17', np.nan, np.nan, '(2) Female', np.nan, np.nan,
+     '(8) Residue', '(9) Out of universe'),
+    # crime type without a category: dropped
+    ('(99) Other', no, no, '(1) White', np.nan, np.nan, np.nan, np.nan,
+     '(4) 18-20', np.nan, np.nan, '(1) Male', np.nan, np.nan, yes, yes),
+  ], columns=columns)
+
+
+def test_preprocess_stages():
+  df = _incidents()
+  for stage in [
+      ncvs._process_crime_type, ncvs._process_offender_race,
+      ncvs._process_offender_age, ncvs._process_offender_sex,
+      ncvs._process_reported_to_police,
+      ncvs._process_arrests_or_charges_made]:
+    df = stage(df)
+  assert df.index.tolist() == [0, 1, 3]
+  assert df['crime_recode'].tolist() == [
+    'sex offense', 'property', 'simple assault']
+  assert df['offender_race'].tolist() == ['Black', 'White', 'Black']
+  assert df['offender_age'].tolist() == ['18-29', '> 29', '< 18']
+  assert df['offender_sex'].tolist() == ['Male', 'Female', 'Female']
+  np.testing.assert_array_equal(df['reported_to_police'], [1.0, 0.0, np.nan])
+  np.testing.assert_array_equal(df['arrests_or_charges_made'], [1.0, 0.0, 0.0])
+
+
+def test_load(tmp_path, monkeypatch):
+  monkeypatch.setattr(load, 'data_path', tmp_path)
+  monkeypatch.setattr(utils, 'CACHE_DIR', tmp_path / 'cache')
+  df = _incidents().rename(columns={'crime_type': 'toc_code_new_ncvs'})
+  df['ncvs_year'] = [1993, 1993, 2011, 2012, 2012]
+  df['idhh'] = range(len(df))  # not read
+  df.to_csv(tmp_path / 'ncvs.csv.zip', index=False,
+            compression={'method': 'zip', 'archive_name': 'ncvs.csv'})
+
+  fresh = load.load()
+  assert list((tmp_path / 'cache').glob('*.parquet'))
+  cached = load.load()
+  pd.testing.assert_frame_equal(fresh, cached)
+  pd.testing.assert_frame_equal(load.load(use_cache=False), cached)
+
+  assert set(cached.columns) == {
+    'crime_type', 'ncvs_year', *load.LABEL_COLUMNS[1:]}
+  assert cached['ncvs_year'].dtype == np.int16
+  assert (cached.drop(columns='ncvs_year').dtypes == 'category').all()
+  assert cached['crime_type'].tolist() == _incidents()['crime_type'].tolist()
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from cj_pipeline.neulaw import load, preprocess as neulaw
+
+
+def _charges():
+  columns = [
+    'def.uid', 'def.gender', 'def.race', 'calc.race', 'def.dob',
+    'calc.casenr', 'case.date', 'off.date', 'disp.date', 'calc.disp',
+    'calc.broad', 'case.degree', 'off.code', 'disp.literal', 'calc.detailed',
+    'offense_category']
+  df = pd.DataFrame([
+    # defendant 1: two prior charges (the second still pending), then the
+    # current one; the degrees of the Theft/Drugs charges are missing
+    (1, 'Male', 'Black', 'Black', '1980-01-01', 'c1', '2000-01-10',
+     '2000-01-01', '2000-03-01', 'Guilty', 'Theft', np.nan, 123456.0,
+     'COMMITTED TO TDC', 'Theft', 'property'),
+    (1, 'Male', 'Black', 'Black', '1980-01-01', 'c2', '2005-06-01',
+     '2005-05-01', '2010-02-01', 'Guilty', 'Burglary', 'F1', 220001.0,
+     np.nan, 'Burglary', 'burglary'),
+    (1, 'Male', 'Black', 'Black', '1980-01-01', 'c3', '2010-01-01',
+     '2009-12-01', '2010-06-01', 'Dismissal', 'Drugs', np.nan, 999.0,
+     'PROBATION', 'Drugs', 'drugs_use'),
+    # defendant 2: a single (current) charge without a degree
+    (2, 'Female', 'White', 'White', '1990-05-05', 'c4', '2012-03-03',
+     '2012-03-01', '2012-09-01', 'Guilty', 'Theft', np.nan, np.nan,
+     np.nan, 'Theft', 'property'),
+    # no defendant id, or a missing gender: not in the history
+    (np.nan, 'Male', 'Black', 'Black', '1985-01-01', 'c5', '2011-01-01',
+     '2011-01-01', '2011-02-01', 'Guilty', 'Burglary', 'F2', 220001.0,
+     'STATE JAIL', 'Burglary', 'burglary'),
+    (3, 'Missing', 'White', 'White', '1970-01-01', 'c6', '2001-01-01',
+     '2001-01-01', '2001-02-01', 'Guilty', 'Arson', 'F1', 1.0,
+     'FINE', 'Arson', 'arson'),
+  ], columns=columns)
+  df['calc.year'] = pd.to_datetime(df['case.date']).dt.year
+  return df
+
+
+def test_reduce_skips_missing():
+  col = pd.Series([True, np.nan, False, np.nan, True], dtype=object)
+  order, starts = np.array([4, 3, 2, 1, 0]), np.array([0, 2])
+  np.testing.assert_array_equal(
+    neulaw._reduce(col, order, starts, 'sum'), [1, 1])
+  np.testing.assert_array_equal(
+    neulaw._reduce(col, order, starts, 'first'), [True, True])
+
+
+def test_missing_degree():
+  history = neulaw.preprocess(_charges()).set_index('def.uid')
+  assert history.loc[1, 'felony_count'] == 1
+  assert history.loc[1, 'misdemeanor_count'] == 0
+  assert history.loc[1, 'conviction_count'] == 2
+  assert not history.loc[1, 'current.felony']
+  assert not history.loc[2, 'current.felony']
+  assert history.loc[2, 'current.conviction']
+
+
+def test_charge_flags():
+  df = neulaw._generic_preprocessing(_charges(), -1, np.inf)
+  df = neulaw._get_age(neulaw._conv_dates(df.reset_index(drop=True)))
+  flags = neulaw._charge_flags(df)
+  assert (flags.dtypes == bool).all()  # missing degrees are not felonies
+  assert flags['felony'].tolist() == [False, True, False, False, True, True]
+
+
+def test_preprocess():
+  history = neulaw.preprocess(_charges())
+  assert history['def.uid'].tolist() == [2, 1]  # in key order
+  expected = pd.DataFrame({
+    'current_age': ['18-30', '18-30'],
+    'last_arrest_date': pd.to_datetime(['2012-03-03', '2010-01-01']),
+    'fta_lt_2yr_count': [0, 0],
+    'violent_conviction_count': [0, 1],
+    'violent_conviction_adult_count': [0, 1],
+    'incarceration_count': [0, 1],
+    'conviction_count': [0, 2],
+    'not_dismissed_count': [0, 2],
+    'felony_count': [0, 1],
+    'violent_pending_count': [0, 1],
+    'pending_charge_count': [0, 1],
+    'current.felony': [False, False],
+    'current.conviction': [True, False],
+    'most_serious_offense': ['Theft', 'Burglary'],
+  })
+  pd.testing.assert_frame_equal(
+    history[expected.columns].reset_index(drop=True), expected)
+  first_arrest = pd.to_datetime(['2012-03-03', '2000-01-10'])
+  dob = pd.to_datetime(['1990-05-05', '1980-01-01'])
+  np.testing.assert_allclose(
+    history['age_first_arrest'], (first_arrest - dob).days / 365.25)
+
+
+def test_preprocess_years():
+  history = neulaw.preprocess(_charges(), 2005, 2010)
+  assert history['def.uid'].tolist() == [1]
+  assert history['conviction_count'].item() == 1
+  assert history['pending_charge_count'].item() == 1
+
+
+def _write(path):
+  charges = _charges()
+  charges.drop(columns='offense_category').to_csv(path / 'hc.csv', index=False)
+  categories = charges[['calc.detailed', 'offense_category']].drop_duplicates()
+  categories.to_csv(path / 'neulaw_offensecat.csv', index=False)
+  return charges
+
+
+def test_load(tmp_path, monkeypatch):
+  monkeypatch.setattr(load, '_CHUNKSIZE', 2)  # categories differ by chunk
+  charges = _write(tmp_path)
+  df = load.load(tmp_path, start_year=2005)
+  assert df['calc.year'].tolist() == [2005, 2010, 2012, 2011]
+  assert df['case.degree'].dtype.name == 'category'
+  assert df['case.date'].dtype.kind == 'M'
+  assert df['offense_category'].tolist() == [
+    'burglary', 'drugs_use', 'property', 'burglary']
+  assert set(df.columns) == set(charges.columns)
+
+  sample = load._load_hc(tmp_path, sample_idxs=[3, 0, 3])
+  assert sample.index.tolist() == [3, 0, 3]
+  assert sample['calc.casenr'].tolist() == ['c4', 'c1', 'c4']
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+from cj_pipeline import utils
+from cj_pipeline.nsduh import load
+from cj_pipeline.nsduh.preprocess import process_dui_like
+
+
+def test_partially_labelled_stata(tmp_path, monkeypatch):
+  monkeypatch.setattr(load, 'data_path', tmp_path)
+  monkeypatch.setattr(utils, 'CACHE_DIR', tmp_path / 'cache')
+  df = pd.DataFrame({
+    'DRVALDR': np.array([1, 2, 81, 91, 1, 99], dtype='int16'),
+    'IRSEX': np.array([1, 2, 1, 2, 1, 2], dtype='int8'),
+  })
+  df.to_stata(  # only some of the DRVALDR codes are labelled
+    tmp_path / 'NHSDA-1999-DS0001-data-stata.dta', write_index=False,
+    value_labels={'DRVALDR': {1: 'Yes', 2: 'No'},
+                  'IRSEX': {1: 'Male', 2: 'Female'}})
+
+  fresh = load.read_nsduh(1999)
+  assert list((tmp_path / 'cache').glob('*.parquet'))
+  cached = load.read_nsduh(1999)
+  pd.testing.assert_frame_equal(fresh, cached)
+  pd.testing.assert_frame_equal(load.read_nsduh(1999, use_cache=False), cached)
+  recoded = process_dui_like(cached, 'DRVALDR')['DRVALDR']
+  assert recoded.tolist() == [1, 2, 81, 91, 1, 99]
+
+
+def _chunks(df, chunksize):
+  return (df.iloc[i:i + chunksize] for i in range(0, len(df), chunksize))
+
+
+def _survey(n=1000):
+  return pd.DataFrame({'IRSEX': np.arange(n) % 2 + 1, 'row': np.arange(n)})
+
+
+def test_sample_n():
+  df = _survey()
+  sample = load._sample_chunks(_chunks(df, 300), sample_n=50, seed=1)
+  assert len(sample) == 50 and sample['row'].is_unique
+  assert sample['row'].is_monotonic_increasing  # file order
+  for chunksize in (77, 1000):  # does not depend on chunking
+    pd.testing.assert_frame_equal(
+      sample, load._sample_chunks(_chunks(df, chunksize), sample_n=50, seed=1))
+  other = load._sample_chunks(_chunks(df, 300), sample_n=50, seed=2)
+  assert not sample.equals(other)
+  everything = load._sample_chunks(_chunks(df, 300), sample_n=2000, seed=1)
+  pd.testing.assert_frame_equal(everything, df)
+
+
+def test_sample_frac():
+  df = _survey()
+  sample = load._sample_chunks(_chunks(df, 300), sample_frac=0.2, seed=1)
+  assert 150 < len(sample) < 250 and sample['row'].is_monotonic_increasing
+  pd.testing.assert_frame_equal(
+    sample, load._sample_chunks(_chunks(df, 77), sample_frac=0.2, seed=1))
+  assert not sample.equals(
+    load._sample_chunks(_chunks(df, 300), sample_frac=0.2, seed=2))
+
+
+def test_read_nsduh_sample(tmp_path, monkeypatch):
+  monkeypatch.setattr(load, 'data_path', tmp_path)
+  _survey().drop(columns='row').to_csv(
+    tmp_path / 'NSDUH_2005_Tab.txt', sep='\t', index=False)
+  sample = load.read_nsduh(2005, sample_n=50, seed=3, use_cache=False)
+  assert len(sample) == 50 and (sample['YEAR'] == 2005).all()
+  pd.testing.assert_frame_equal(
+    sample, load.read_nsduh(2005, sample_n=50, seed=3, use_cache=False))
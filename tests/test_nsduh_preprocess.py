@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+from cj_pipeline.nsduh import preprocess as nsduh
+
+NA = pd.NA
+
+
+def _codes(rows, rules):
+  """Integer coded respondents; variables of `rules` not in `rows` are NA."""
+  columns = sorted({
+    col for clauses in rules.values() for conditions, _ in clauses
+    for columns, _ in conditions for col in columns} - set(rules))
+  df = pd.DataFrame(rows, columns=columns, dtype=object)
+  return df.astype(pd.Int32Dtype())
+
+
+def _check_outcomes(df, expected):
+  for outcome, values in expected.items():
+    pd.testing.assert_series_equal(
+      df[outcome], pd.Series(values, dtype=pd.BooleanDtype(), name=outcome))
+
+
+def test_dui_rules():
+  df = _codes([
+    # an earlier clause wins: DRVINALCO2 says yes, DRVALDR says no
+    {'DRVINALCO2': 1, 'DRVALDR': 2, 'BKDRVINF': 1, 'BOOKED': 1, 'NOBOOKY2': 3},
+    # DRUNKDRV yes beats DRVINALCO2 no, BKOTHOFF beats BKDRVINF no
+    {'DRVINALCO2': 0, 'DRUNKDRV': 3, 'BKDRVINF': 2, 'BKOTHOFF': 10,
+     'BOOKED': 2, 'NOBOOKY2': 999},
+    # booked, but no DUI to be arrested for
+    {'DRVALDR': 91, 'BKDRVINF': 2, 'BOOKED': 1, 'NOBOOKY2': 5},
+    # missing values never match
+    {},
+    {'DRUNKDRV': 2, 'BKDRVINF': 99, 'NOBOOKY2': 0},
+  ], nsduh.DUI_RULES)
+  df = nsduh._apply_rules(df, nsduh.DUI_RULES)
+  _check_outcomes(df, {
+    'dui': [True, True, False, NA, False],
+    'dui_arrests': [True, True, False, NA, False],
+    'dui_lam': [True, False, NA, NA, NA],
+    'dui_lam_12': [True, False, NA, NA, False],
+  })
+
+
+def test_drugs_rules():
+  df = _codes([
+    # an earlier clause wins: YEYSELL says sold, SOLDDRUG says not
+    {'YEYSELL': 2, 'SOLDDRUG': 2, 'MRJMON': 1, 'BKDRUG': 1, 'BOOKED': 3,
+     'NOBOOKY2': 20},
+    # SOLDDRUG yes beats YEYSELL no, HALLREC yes beats MRJMON no
+    {'YEYSELL': 1, 'SOLDDRUG': 1, 'MRJMON': 0, 'HALLREC': 7, 'BKDRUG': 4,
+     'BOOKED': 2, 'NOBOOKY2': 21},
+    # booked, but no drugs sold or used to be arrested for
+    {'SNYSELL': 1, 'HALLREC': 12, 'BOOKED': 1, 'NOBOOKY2': 0},
+    # missing values never match
+    {},
+  ], nsduh.DRUGS_RULES)
+  df = nsduh._apply_rules(df, nsduh.DRUGS_RULES)
+  _check_outcomes(df, {
+    'drugs_arrest': [True, False, NA, NA],
+    'drugs_sold': [True, True, False, NA],
+    'drugs_sold_lam': [True, False, NA, NA],
+    'drugs_sold_lam_12': [True, NA, False, NA],
+    'drugs_use': [True, True, False, NA],
+    'drugs_use_lam': [True, False, NA, NA],
+    'drugs_use_lam_12': [True, NA, False, NA],
+  })
+
+
+def test_add_dui_drops_sources():
+  df = _codes([{'DRVINALCO2': 1, 'BOOKED': 1}], nsduh.DUI_RULES)
+  df = nsduh.add_dui(df)
+  assert set(df.columns) == {'BOOKED', 'NOBOOKY2', *nsduh.DUI_RULES}
+
+
+def test_recoders():
+  # partially labelled Stata columns: labels and bare codes in one category
+  labels = {
+    'DRVALDR': (nsduh.process_dui_like, [
+      'Yes', 'No', 'No (answered in error)',
+      'LEGITIMATE SKIP Logically assigned',
+      'NEVER USED ALCOHOL OR DRUGS', 81, 'BAD DATA Logically assigned', None],
+     [1, 2, 2, 2, 2, 81, NA, NA]),
+    'YEYSELL': (nsduh.process_drug_sell, [
+      '0 times', '3 to 5 times', 'LEGITIMATE SKIP', 99, None],
+     [1, 2, 1, 99, NA]),
+    'NOBOOKY2': (nsduh.process_nobooky2, [
+      'None', 'Two times', 'LEGITIMATE SKIP (BOOKED=2)', 999, 'REFUSED'],
+     [0, 1, 0, 999, NA]),
+    'MRJMON': (nsduh.process_drugmon, [
+      'Used within the past month (IRMJRC=1)',
+      'Did not use in the past month (IRMJRC=2,3,9)', 'Used', None],
+     [1, 0, NA, NA]),
+    'CATAG3': (nsduh.process_catag3, [
+      '12-17 Years Old', '50 or Older', '26-34 Years Old', 3],
+     [1, 5, 3, 3]),
+  }
+  for name, (recode, values, codes) in labels.items():
+    df = pd.DataFrame({name: pd.Categorical(values)})
+    df = recode(df, name=name)
+    pd.testing.assert_series_equal(
+      df[name], pd.Series(codes, dtype=pd.Int32Dtype(), name=name))
+
+
+def test_add_race():
+  df = pd.DataFrame({
+    'NEWRACE2': [7, NA, 1, NA, 2, NA, NA, 5],
+    'IRHOIND': [NA, 1, NA, NA, NA, NA, NA, 2],
+    'IRRACE': [4, 3, NA, 4, 4, 3, NA, 1],
+  }, dtype=pd.Int32Dtype())
+  df = nsduh.add_race(df)
+  assert df.index.tolist() == [0, 1, 2, 3, 4, 5]  # no race: dropped
+  assert df['offender_race'].tolist() == [
+    'Hispanic', 'Hispanic', 'White', 'White', 'White', 'Black']
+  assert df.columns.tolist() == ['IRHOIND', 'offender_race']
+
+
+def test_add_age():
+  df = pd.DataFrame(
+    {'CATAG3': [1, 2, 3, 4, 5, NA, 0]}, dtype=pd.Int32Dtype())
+  df = nsduh.add_age(df)
+  assert df.index.tolist() == [0, 1, 2, 3, 4]  # no age: dropped
+  assert df['offender_age'].tolist() == [
+    '< 18', '18-34', '18-34', '> 34', '> 34']
+  assert df.columns.tolist() == ['offender_age']
+
+
+def test_derive_outcomes_dtypes():
+  df = pd.DataFrame({
+    'YEAR': [2015, 2015, 2016],
+    'CATAG3': pd.Categorical(
+      ['12-17 Years Old', '50 or Older', '18-25 Years Old']),
+    'NEWRACE2': pd.Categorical(['NonHisp White', 'NonHisp Black/Afr Am', 7]),
+    'IRSEX': [1, 2, 1],
+    'DRVALDR': pd.Categorical(['Yes', 'No', None]),
+    'BOOKED': pd.Categorical(['Yes', 'No', 'LEGITIMATE SKIP']),
+  })
+  df = nsduh.derive_outcomes(df)
+  for name, dtype in nsduh.DTYPE_PLAN.items():
+    if name != 'IRSEX':  # renamed to offender_sex
+      assert df[name].dtype == dtype, name
+  assert df['IRHOIND'].dtype == pd.Int8Dtype()  # not in the survey: all NA
+
+  assert df['YEAR'].tolist() == [2015, 2015, 2016]
+  assert df['offender_sex'].tolist() == ['Male', 'Female', 'Male']
+  assert df['offender_race'].tolist() == ['White', 'Black', 'Hispanic']
+  assert df['offender_age'].tolist() == ['< 18', '> 34', '18-34']
+  _check_outcomes(df, {
+    'dui': [True, False, NA],
+    'dui_lam': [True, False, False],
+  })
+
+
+def _survey(year, n=40):
+  rng = np.random.default_rng(year)
+
+  def _labels(values):
+    return pd.Categorical(rng.choice(np.array(values, dtype=object), n))
+
+  return pd.DataFrame({
+    'YEAR': year,
+    'CATAG3': _labels(['12-17 Years Old', '26-34 Years Old', '50 or Older']),
+    'NEWRACE2': _labels(['NonHisp White', 'NonHisp Black/Afr Am', 7]),
+    'IRSEX': rng.choice([1, 2], n),
+    'DRVALDR': _labels(['Yes', 'No', 'LEGITIMATE SKIP']),
+    'BKDRVINF': _labels(['Yes', 'No']),
+    'YEYSELL': _labels(['0 times', '1 or 2 times']),
+    'MRJMON': _labels([
+      'Used within the past month (IRMJRC=1)',
+      'Did not use in the past month (IRMJRC=2,3,9)']),
+    'BKDRUG': _labels(['Yes', 'No']),
+    'BOOKED': _labels(['Yes', 'No']),
+    'NOBOOKY2': _labels(['None', 'One time']),
+  })
+
+
+def test_preprocess_streaming():
+  years = [2015, 2016, 2017]
+  dfs = nsduh.preprocess(
+    pd.concat([_survey(year) for year in years], ignore_index=True))
+  streamed = nsduh.preprocess_streaming(_survey(year) for year in years)
+  assert streamed.keys() == dfs.keys()
+  for mode in dfs:
+    pd.testing.assert_frame_equal(streamed[mode], dfs[mode])
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+from cj_pipeline.config import SMOOTHING
+from cj_pipeline.utils import (
+  expand_grid, smooth_arrest_rates, smooth_arrest_rates_all,
+  validate_smoothing)
+
+
+def _data(seed=0):
+  rng = np.random.default_rng(seed)
+  df = pd.DataFrame(
+    [(g, year) for g in 'abc' for year in range(2000, 2010)],
+    columns=['group', 'year'])
+  df['count'] = rng.integers(1, 50, len(df))
+  df['rate'] = rng.random(len(df)) * (rng.random(len(df)) > 0.3)
+  df.loc[df['group'] == 'c', 'rate'] = 0.0  # nothing left for `_pr`
+  return df
+
+
+def _smooth(df, mode, **kwargs):
+  x_test = np.arange(1998, 2012)[:, None]
+  return smooth_arrest_rates(
+    df, groups=['group', 'year'], x_test=x_test, x_col='year',
+    count_col='count', arrest_col='rate', smooth_col='smooth', mode=mode,
+    **kwargs)
+
+
+def test_linear_smoother():
+  df = _data()
+  smoothed = _smooth(df, 'lr_pr')
+  for g in 'ab':
+    data = df[(df['group'] == g) & (df['rate'] > 0)]
+    coef = np.polyfit(
+      data['year'], data['rate'], deg=1, w=np.sqrt(data['count']))
+    expected = np.polyval(coef, np.arange(1998, 2012)).clip(min=0)
+    np.testing.assert_allclose(
+      smoothed.loc[smoothed['group'] == g, 'smooth'], expected, atol=1e-10)
+  assert smoothed.loc[smoothed['group'] == 'c', 'smooth'].isna().all()
+  assert smoothed['year'].dtype == df['year'].dtype
+
+
+def test_avg_smoother():
+  df = _data()
+  smoothed = _smooth(df, 'avg_all')
+  for g in 'abc':
+    data = df[df['group'] == g]
+    expected = np.average(data['rate'], weights=data['count'])
+    np.testing.assert_allclose(
+      smoothed.loc[smoothed['group'] == g, 'smooth'], expected)
+  df.loc[df['group'] == 'a', 'count'] = 0  # data, but no weight
+  smoothed = _smooth(df, 'avg_all')
+  assert (smoothed.loc[smoothed['group'] == 'a', 'smooth'] == 0).all()
+
+
+def test_missing_group_key():
+  df = _data()
+  expected = _smooth(df[df['group'] != 'c'], 'lr_all')
+  df.loc[df['group'] == 'c', 'group'] = np.nan  # rows left out
+  pd.testing.assert_frame_equal(_smooth(df, 'lr_all'), expected)
+  errors = validate_smoothing(
+    df, groups=['group', 'year'], x_col='year', count_col='count',
+    arrest_col='rate', modes=SMOOTHING)
+  assert set(errors['group']) == {'a', 'b'}
+
+def test_all_modes():
+  df = _data()
+  smoothed = smooth_arrest_rates_all(
+    df, groups=['group', 'year'], x_test=np.arange(1998, 2012)[:, None],
+    x_col='year', count_col='count', arrest_col='rate', smooth_col='smooth',
+    modes=SMOOTHING)
+  assert list(smoothed['smoothing'].unique()) == SMOOTHING
+  for mode in SMOOTHING:
+    expected = _smooth(df, mode)
+    actual = smoothed[smoothed['smoothing'] == mode].drop(columns='smoothing')
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected)
+
+
+def test_validate_smoothing():
+  df = _data()
+  df = df[(df['group'] != 'b') | (df['year'] < 2002)]  # 2 years only
+  errors = validate_smoothing(
+    df, groups=['group', 'year'], x_col='year', count_col='count',
+    arrest_col='rate', modes=SMOOTHING)
+  for mode in SMOOTHING:
+    for g in 'abc':
+      data = df[df['group'] == g]
+      sq_errors, weights = [], []
+      for i in data.index:  # refit without each year
+        smoothed = _smooth(df.drop(index=i), mode)
+        smoothed = smoothed[
+          (smoothed['group'] == g) & (smoothed['year'] == df.at[i, 'year'])]
+        if smoothed['smooth'].notna().all():
+          sq_errors.append((smoothed['smooth'].item() - df.at[i, 'rate'])**2)
+          weights.append(df.at[i, 'count'])
+      error = errors[(errors['smoothing'] == mode) & (errors['group'] == g)]
+      assert error['n_years'].item() == len(weights)
+      if weights:
+        expected = np.average(sq_errors, weights=weights)**0.5
+        np.testing.assert_allclose(error['loyo_rmse'].item(), expected)
+
+
+def test_eb_smoother():
+  df = _data()
+  df = df.rename(columns={'group': 'offender_age'}).assign(offender_race='x')
+  df.loc[df['offender_age'] == 'c', 'rate'] = np.nan  # filled by the parent
+  x_test = np.arange(1998, 2012)[:, None]
+  smoothed = smooth_arrest_rates_all(
+    df, groups=['offender_race', 'offender_age', 'year'], x_test=x_test,
+    x_col='year', count_col='count', arrest_col='rate', smooth_col='smooth',
+    modes=['lr_all', 'eb_all'])
+  parent = smooth_arrest_rates(
+    df.assign(offender_age='all'), groups=['offender_race', 'year'],
+    x_test=x_test, x_col='year', count_col='count', arrest_col='rate',
+    smooth_col='smooth', mode='lr_all')['smooth'].to_numpy()
+
+  def _get(mode, age):
+    return smoothed.loc[(smoothed['smoothing'] == mode)
+                        & (smoothed['offender_age'] == age), 'smooth'].to_numpy()
+
+  np.testing.assert_allclose(_get('eb_all', 'c'), parent)
+  for age in 'ab':  # between the own and the parent trend
+    own, pooled = _get('lr_all', age), _get('eb_all', age)
+    assert np.all((pooled - own) * (pooled - parent) <= 1e-12)
+    assert not np.allclose(pooled, own)
+
+
+def test_bootstrap_bands():
+  df = _data()
+  smoothed = _smooth(df, 'lr_pr', n_boot=200)
+  assert list(smoothed.columns) == [
+    'group', 'smooth', 'smooth_lo', 'smooth_hi', 'year']
+  fitted = smoothed[smoothed['group'] != 'c']
+  assert (fitted['smooth_lo'] <= fitted['smooth_hi']).all()
+  assert (fitted['smooth_lo'] < fitted['smooth_hi']).any()
+  assert smoothed.loc[smoothed['group'] == 'c', 'smooth_lo'].isna().all()
+  pd.testing.assert_frame_equal(smoothed, _smooth(df, 'lr_pr', n_boot=200))
+
+
+def test_expand_grid():
+  df = pd.DataFrame(
+    {'group': ['b', 'a', 'b'], 'year': [2001, 2000, 2000], 'count': [1, 2, 3]})
+  expanded = expand_grid(df, ['group', 'year'])
+  assert list(zip(expanded['group'], expanded['year'])) == [
+    ('b', 2001), ('b', 2000), ('a', 2001), ('a', 2000)]
+  np.testing.assert_array_equal(expanded['count'], [1, 3, np.nan, 2])
+  sparse = expand_grid(df, ['group', 'year'], sparse=True)
+  assert isinstance(sparse['count'].dtype, pd.SparseDtype)
+  np.testing.assert_array_equal(
+    sparse['count'].sparse.to_dense(), expanded['count'])